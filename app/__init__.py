@@ -6,8 +6,24 @@ from flask_script import Manager
 from flask_sqlalchemy import SQLAlchemy
 
 TELEGRAM_TOKEN = environ['TELEGRAM_TOKEN']
+
+
+def engine_options(prefix: str) -> dict:
+    # Pool settings of one database, e.g. DATABASE_POOL_SIZE for the
+    # primary and DATABASE_REPLICA_POOL_SIZE for the replica. Unset ones
+    # keep SQLAlchemy's defaults.
+    options = {}
+    for name, cast in (('POOL_SIZE', int), ('MAX_OVERFLOW', int),
+                       ('POOL_TIMEOUT', float), ('POOL_RECYCLE', int)):
+        value = environ.get(f'{prefix}_{name}')
+        if value is not None:
+            options[name.lower()] = cast(value)
+    return options
+
+
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = environ['DATABASE_URL']
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options('DATABASE')
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
@@ -18,8 +34,37 @@ from . import model
 from . import routes
 db.create_all()
 
-if __name__ == "__main__":
-    manager.run()
-else:
-    from app.telegram import set_up_webhooks
+from app.broadcast import run_broadcast
+from app.broadcast import start_broadcast
+from app.polling import run_polling
+from app.telegram import set_up_webhooks
+
+
+@manager.command
+def register_webhooks():
     set_up_webhooks()
+
+
+@manager.command
+def poll():
+    run_polling()
+
+
+@manager.option('-b', '--bot', dest='bot_token', required=True)
+@manager.option('-t', '--text', dest='text', required=True)
+def broadcast(bot_token: str, text: str):
+    run_broadcast(start_broadcast(bot_token, text))
+
+
+@manager.option('-i', '--id', dest='broadcast_id', type=int, required=True)
+def resume_broadcast(broadcast_id: int):
+    run_broadcast(broadcast_id)
+
+
+@manager.option('-h', '--host', dest='host', default='0.0.0.0')
+@manager.option('-p', '--port', dest='port', type=int,
+                default=int(environ.get('PORT', 8000)))
+def serve_async(host: str, port: int):
+    # aiohttp is only needed for this mode, so it is imported here.
+    from app.aio import serve
+    serve(host, port)
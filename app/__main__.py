@@ -0,0 +1,3 @@
+from app import manager
+
+manager.run()
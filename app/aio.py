@@ -0,0 +1,162 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from typing import Dict
+
+from aiohttp import ClientSession
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
+from aiohttp import TraceConfig
+from aiohttp import web
+from werkzeug.test import EnvironBuilder
+from werkzeug.test import run_wsgi_app
+
+from app import app
+from app import db
+from app.client import TELEGRAM_API_URL
+from app.client import TELEGRAM_TIMEOUT
+from app.client import use_client
+from app.metrics import webhook_seconds
+from app.model import known_bot_label
+from app.routes import handle_webhook_update
+from app.sharding import SHARD_FORWARDED_HEADER
+from app.tracing import TRACE_HEADER
+from app.tracing import should_trace
+
+AIO_HANDLER_THREADS = int(environ.get('AIO_HANDLER_THREADS', 32))
+AIO_POOL_SIZE = int(environ.get('AIO_POOL_SIZE', 100))
+
+
+class AioTelegramClient:
+    # Same interface as TelegramClient, but the requests run on the event
+    # loop, so a handler thread waiting on Telegram holds no socket of its
+    # own and the loop multiplexes all of them over one connection pool.
+    def __init__(self, loop, base_url: str, pool_size: int, timeout: float):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._loop = loop
+        self._requests = 0
+        self._connections = 0
+
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self._count_request)
+        trace_config.on_connection_create_end.append(self._count_connection)
+        self._session = ClientSession(
+            connector=TCPConnector(limit=pool_size),
+            timeout=ClientTimeout(total=timeout),
+            trace_configs=[trace_config],
+        )
+
+    async def _count_request(self, session, context, params):
+        self._requests += 1
+
+    async def _count_connection(self, session, context, params):
+        self._connections += 1
+
+    async def _call(self, bot_token: str, command: str, data: dict) -> dict:
+        if data is not None:
+            # requests drops None values from form data, so do the same.
+            data = {key: value for key, value in data.items()
+                    if value is not None}
+        async with self._session.post(
+                f'{self.base_url}/bot{bot_token}/{command}',
+                data=data) as response:
+            return await response.json(content_type=None)
+
+    def call(self, bot_token: str, command: str, data: dict = None) -> dict:
+        future = asyncio.run_coroutine_threadsafe(
+            self._call(bot_token, command, data), self._loop)
+        return future.result()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'requests': self._requests,
+            'new_connections': self._connections,
+            'reused_connections': self._requests - self._connections,
+        }
+
+    async def close(self):
+        await self._session.close()
+
+
+def _answer_update(bot_token: str, update: dict, trace: bool,
+                   forwarded: bool):
+    with app.app_context():
+        try:
+            return handle_webhook_update(bot_token, update, trace,
+                                         forwarded=forwarded)
+        finally:
+            db.session.remove()
+
+
+def _answer_wsgi(environ: dict):
+    app_iter, status, headers = run_wsgi_app(app, environ, buffered=True)
+    return b''.join(app_iter), status, headers
+
+
+async def webhook(request: web.Request) -> web.Response:
+    bot_token = request.match_info['bot_token']
+    started = time.perf_counter()
+    try:
+        update = await request.json()
+        print(update)
+        trace = should_trace(request.headers.get(TRACE_HEADER))
+        forwarded = SHARD_FORWARDED_HEADER in request.headers
+        loop = asyncio.get_running_loop()
+        reply, status = await loop.run_in_executor(
+            request.app['executor'], _answer_update, bot_token, update, trace,
+            forwarded)
+        if reply is None:
+            return web.Response(status=status)
+        return web.json_response(reply)
+    finally:
+        webhook_seconds.observe(time.perf_counter() - started,
+                                known_bot_label(bot_token))
+
+
+async def fallback(request: web.Request) -> web.Response:
+    # Everything except the webhook is rare and served by the Flask app.
+    environ = EnvironBuilder(
+        path=request.path,
+        method=request.method,
+        query_string=request.query_string,
+        headers=list(request.headers.items()),
+        data=await request.read(),
+    ).get_environ()
+    loop = asyncio.get_running_loop()
+    body, status, headers = await loop.run_in_executor(
+        request.app['executor'], _answer_wsgi, environ)
+    response = web.Response(body=body, status=int(status.split()[0]))
+    for name, value in headers.items():
+        if name.lower() not in ('content-length', 'transfer-encoding'):
+            response.headers[name] = value
+    return response
+
+
+async def _start(application: web.Application):
+    # Handlers still talk to the database synchronously, so they run on a
+    # bounded thread pool that should not outgrow the SQLAlchemy pool.
+    application['executor'] = ThreadPoolExecutor(AIO_HANDLER_THREADS)
+    application['client'] = AioTelegramClient(
+        asyncio.get_running_loop(), TELEGRAM_API_URL, AIO_POOL_SIZE,
+        TELEGRAM_TIMEOUT)
+    use_client(application['client'])
+
+
+async def _stop(application: web.Application):
+    application['executor'].shutdown(wait=True)
+    await application['client'].close()
+
+
+def create_app() -> web.Application:
+    application = web.Application()
+    application.router.add_post('/webhook/{bot_token}', webhook)
+    application.router.add_route('*', '/{tail:.*}', fallback)
+    application.on_startup.append(_start)
+    application.on_cleanup.append(_stop)
+    return application
+
+
+def serve(host: str, port: int):
+    web.run_app(create_app(), host=host, port=port)
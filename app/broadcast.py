@@ -0,0 +1,84 @@
+import time
+from os import environ
+
+from app import db
+from app.model import Broadcast
+from app.model import ChildBot
+from app.model import User
+from app.ratelimit import TokenBucket
+from app.replica import read_query
+from app.telegram import send_message
+
+BROADCAST_RATE = float(environ.get('BROADCAST_RATE', 25))
+BROADCAST_BATCH = int(environ.get('BROADCAST_BATCH', 1000))
+
+
+def start_broadcast(bot_token: str, text: str) -> int:
+    bot = ChildBot.get_by_token(bot_token)
+    if bot is None:
+        raise ValueError('Unknown bot token')
+
+    broadcast = Broadcast()
+    broadcast.bot_id = bot.id
+    broadcast.text = text
+    db.session.add(broadcast)
+    db.session.commit()
+    return broadcast.id
+
+
+def run_broadcast(broadcast_id: int):
+    broadcast = Broadcast.query.get(broadcast_id)
+    if broadcast is None or broadcast.finished:
+        return
+
+    bot_token = db.session.query(ChildBot.token).filter(
+        ChildBot.id == broadcast.bot_id).scalar()
+    # The bot's own limiter caps it at Telegram's 30/s. This bucket keeps
+    # some of that budget free for replies to users while it runs.
+    bucket = TokenBucket(BROADCAST_RATE, 1)
+    started = time.monotonic()
+    sent_before = broadcast.sent
+
+    text = broadcast.text
+    while True:
+        # Keyset pages instead of one long running cursor: memory stays
+        # constant and no transaction is held open for hours. The
+        # checkpoint commits do not touch users, so pages keep coming from
+        # the replica.
+        users = read_query(User.id, User.tg_id, follow_writes=False).filter(
+            User.bot_id == broadcast.bot_id,
+            User.id > broadcast.last_user_id,
+            User.blocked.is_(False),
+        ).order_by(User.id).limit(BROADCAST_BATCH).all()
+        if not users:
+            break
+
+        for user_id, tg_id in users:
+            wait = bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                response = send_message(bot_token, tg_id, text)
+            except Exception as error:
+                print(f'Broadcast {broadcast.id} to {tg_id} failed: {error}')
+                response = {'ok': False}
+
+            if response['ok']:
+                broadcast.sent += 1
+            else:
+                broadcast.failed += 1
+            # Checkpoint after every message, so that a resumed broadcast
+            # never sends one twice. At BROADCAST_RATE messages a second a
+            # one-row update each is cheap.
+            broadcast.last_user_id = user_id
+            db.session.commit()
+
+        elapsed = time.monotonic() - started
+        print(f'Broadcast {broadcast.id}: sent {broadcast.sent}, '
+              f'failed {broadcast.failed}, '
+              f'up to user {broadcast.last_user_id}, '
+              f'{(broadcast.sent - sent_before) / elapsed:.1f} msg/s')
+
+    broadcast.finished = True
+    db.session.commit()
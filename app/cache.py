@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any
+from typing import Hashable
+from typing import Optional
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is not MISSING:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+            self.misses += 1
+            return MISSING
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> bool:
+        # Atomic set-if-absent, so only one of two racing callers wins.
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is not MISSING:
+                expires = item[1]
+                if expires is None or expires > now:
+                    return False
+            self._data[key] = (value, None if ttl is None else now + ttl)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def peek(self, key: Hashable) -> Any:
+        # Like get(), but leaves the order and the hit counters alone.
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is MISSING:
+                return MISSING
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                return MISSING
+            return value
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,61 @@
+from os import environ
+from typing import Dict
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+TELEGRAM_API_URL = environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_POOL_SIZE = int(environ.get('TELEGRAM_POOL_SIZE', 10))
+TELEGRAM_TIMEOUT = float(environ.get('TELEGRAM_TIMEOUT', 30))
+
+
+class TelegramClient:
+    def __init__(self, base_url: str, pool_size: int, timeout: float):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+        )
+        self._session = Session()
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+
+    def call(self, bot_token: str, command: str, data: dict = None) -> dict:
+        response = self._session.post(
+            f'{self.base_url}/bot{bot_token}/{command}',
+            data,
+            timeout=self.timeout,
+        )
+        return response.json()
+
+    def stats(self) -> Dict[str, int]:
+        connections = requests = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests += pool.num_requests
+
+        return {
+            'requests': requests,
+            'new_connections': connections,
+            'reused_connections': requests - connections,
+        }
+
+
+_client = TelegramClient(TELEGRAM_API_URL, TELEGRAM_POOL_SIZE,
+                         TELEGRAM_TIMEOUT)
+
+
+def current_client():
+    return _client
+
+
+def use_client(client):
+    # Lets the asyncio server route Bot API calls through its own client.
+    global _client
+    _client = client
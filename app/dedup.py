@@ -0,0 +1,74 @@
+from itertools import count
+from os import environ
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.cache import LRUCache
+from app.metrics import duplicate_updates_total
+from app.model import ProcessedUpdate
+
+DEDUP_WINDOW = float(environ.get('DEDUP_WINDOW', 3600))
+DEDUP_SIZE = int(environ.get('DEDUP_SIZE', 100000))
+DEDUP_STORE = environ.get('DEDUP_STORE', 'memory')
+DEDUP_PRUNE_EVERY = int(environ.get('DEDUP_PRUNE_EVERY', 1000))
+
+
+class UpdateDeduplicator:
+    # Remembers (bot, update_id) pairs for DEDUP_WINDOW seconds. The
+    # memory set catches redeliveries to the same process; with
+    # DEDUP_STORE=postgres the processed_updates table catches the rest.
+    def __init__(self, window: float, size: int, shared: bool):
+        self.window = window
+        self.shared = shared
+        self._seen = LRUCache(size)
+        self._inserts = count(1)
+
+    def first_seen(self, bot_id: int, update_id: Optional[int],
+                   label: str) -> bool:
+        if update_id is None:
+            return True
+
+        fresh = self._seen.add((bot_id, update_id), True, self.window)
+        if fresh and self.shared:
+            try:
+                fresh = self._claim(bot_id, update_id)
+            except Exception:
+                # Unclaimed, so Telegram's retry must not look like a
+                # duplicate here.
+                self._seen.pop((bot_id, update_id))
+                raise
+        if not fresh:
+            duplicate_updates_total.inc(label)
+        return fresh
+
+    def forget(self, bot_id: int, update_id: Optional[int]):
+        # Called when processing failed, so that Telegram's retry runs.
+        if update_id is None:
+            return
+
+        self._seen.pop((bot_id, update_id))
+        if self.shared:
+            db.session.rollback()
+            ProcessedUpdate.query.filter_by(
+                bot_key=bot_id, update_id=update_id).delete()
+            db.session.commit()
+
+    def _claim(self, bot_id: int, update_id: int) -> bool:
+        result = db.session.execute(
+            insert(ProcessedUpdate.__table__).values(
+                bot_key=bot_id, update_id=update_id,
+            ).on_conflict_do_nothing())
+        if next(self._inserts) % DEDUP_PRUNE_EVERY == 0:
+            db.session.execute(text(
+                'DELETE FROM processed_updates '
+                "WHERE seen_at < now() - make_interval(secs => :window)"
+            ), {'window': self.window})
+        db.session.commit()
+        return result.rowcount == 1
+
+
+dedup = UpdateDeduplicator(DEDUP_WINDOW, DEDUP_SIZE,
+                           DEDUP_STORE == 'postgres')
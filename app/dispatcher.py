@@ -0,0 +1,153 @@
+from os import environ
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Tuple
+from typing import Union
+
+from app.metrics import bot_label
+from app.metrics import query_budget_exceeded_total
+from app.metrics import updates_total
+from app.queries import count_queries
+from app.tracing import span
+
+QUERY_BUDGETS = environ.get('QUERY_BUDGETS') == '1'
+
+
+class Update:
+    __slots__ = ('bot_token', 'chat_id', 'user_id', 'text', 'user', 'path')
+
+    def __init__(self, bot_token: str, chat_id: int, user_id: int,
+                 text: str, user, path: Tuple[str, ...]):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.text = text
+        self.user = user
+        self.path = path
+
+
+class _Node:
+    __slots__ = ('children', 'exact', 'patterns', 'any')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = {}
+        self.patterns = []
+        self.any = None
+
+
+class Dispatcher:
+    # Routes are registered against a menu state and a text. States are
+    # '/' separated paths where '*' matches one segment and '**' matches
+    # any number of them, None matches every state. Texts are either an
+    # exact string, a compiled pattern or None for any text.
+    #
+    # Routes without a state are tried first, then states from the most
+    # specific one. Within a state an exact text wins over a pattern and
+    # a pattern over any text.
+    #
+    # max_queries is the number of SQL statements a route may run with
+    # warm caches. When check_queries is set, an update that runs more is
+    # logged and counted. It is not failed: by then its messages have been
+    # sent, and failing it would make Telegram redeliver it and send them
+    # again.
+    def __init__(self, check_queries: bool = QUERY_BUDGETS):
+        self._root = _Node()
+        self._anywhere = _Node()
+        self._budgets = {}
+        self.check_queries = check_queries
+        self.fallback = None
+
+    def route(self, state: Optional[str] = None,
+              text: Union[str, Pattern, None] = None,
+              max_queries: Optional[int] = None):
+        def decorate(handler: Callable) -> Callable:
+            if max_queries is not None:
+                self._budgets[handler] = max_queries
+
+            if state is None:
+                node = self._anywhere
+            else:
+                node = self._root
+                for segment in state.split('/'):
+                    node = node.children.setdefault(segment, _Node())
+
+            if text is None:
+                node.any = handler
+            elif isinstance(text, str):
+                node.exact[text] = handler
+            else:
+                node.patterns.append((text, handler))
+            return handler
+
+        return decorate
+
+    def default(self, max_queries: Optional[int] = None):
+        def decorate(handler: Callable) -> Callable:
+            if max_queries is not None:
+                self._budgets[handler] = max_queries
+
+            self.fallback = handler
+            return handler
+
+        return decorate
+
+    def _match(self, node: _Node, path: Tuple[str, ...], index: int,
+               found: List[_Node]):
+        if index == len(path):
+            found.append(node)
+        else:
+            child = node.children.get(path[index])
+            if child is not None:
+                self._match(child, path, index + 1, found)
+
+            child = node.children.get('*')
+            if child is not None:
+                self._match(child, path, index + 1, found)
+
+        child = node.children.get('**')
+        if child is not None:
+            for end in range(index, len(path) + 1):
+                self._match(child, path, end, found)
+
+    def resolve(self, update: Update) -> Optional[Callable]:
+        nodes = [self._anywhere]
+        self._match(self._root, update.path, 0, nodes)
+
+        for node in nodes:
+            handler = node.exact.get(update.text)
+            if handler is not None:
+                return handler
+
+            for pattern, handler in node.patterns:
+                if pattern.match(update.text):
+                    return handler
+
+            if node.any is not None:
+                return node.any
+
+        return self.fallback
+
+    def dispatch(self, update: Update):
+        handler = self.resolve(update)
+        if handler is None:
+            return
+
+        name = handler.__name__.lstrip('_')
+        updates_total.inc(bot_label(update.bot_token), name)
+
+        budget = self._budgets.get(handler)
+        with span('dispatch', handler=name):
+            if not self.check_queries or budget is None:
+                handler(update)
+                return
+
+            with count_queries() as queries:
+                handler(update)
+
+        if queries.count > budget:
+            query_budget_exceeded_total.inc(name)
+            print(f'{name} ran {queries.count} queries, expected at most '
+                  f'{budget}:\n' + '\n'.join(queries.statements))
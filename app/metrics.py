@@ -0,0 +1,165 @@
+from bisect import bisect_left
+from os import environ
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+METRICS_BOT_LABELS = environ.get('METRICS_BOT_LABELS', '1') == '1'
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def bot_label(bot_token: str) -> str:
+    # The part before ':' is the bot's public id, the rest is the secret.
+    if not METRICS_BOT_LABELS:
+        return ''
+    return bot_token.split(':')[0]
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, labels)} {value}'
+                for labels, value in values]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[labels] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts), total)
+                      for labels, (counts, total) in self._values.items()]
+
+        names = self.labels + ('le',)
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(names, labels + (bound,))} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum'
+                         f'{_format_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count'
+                         f'{_format_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+class CallbackMetric:
+    def __init__(self, name: str, help: str, kind: str,
+                 labels: Tuple[str, ...],
+                 callback: Callable[[], Dict[tuple, float]]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.callback = callback
+        _registry.append(self)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, labels)} {value}'
+                for labels, value in self.callback().items()]
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+webhook_seconds = Histogram(
+    'webhook_seconds', 'Time spent answering a webhook request.', ('bot',))
+update_seconds = Histogram(
+    'update_seconds', 'Time spent processing an update.', ('bot',))
+updates_total = Counter(
+    'updates_total', 'Processed updates by handler.', ('bot', 'handler'))
+update_db_seconds = Histogram(
+    'update_db_seconds', 'Database time spent per update.', ('bot',))
+update_db_queries = Histogram(
+    'update_db_queries', 'SQL statements executed per update.', ('bot',),
+    buckets=(0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 50))
+telegram_seconds = Histogram(
+    'telegram_request_seconds', 'Bot API call latency.', ('bot', 'method'))
+telegram_errors_total = Counter(
+    'telegram_errors_total', 'Bot API calls that were not ok.',
+    ('bot', 'method', 'code'))
+ratelimit_wait_seconds = Histogram(
+    'ratelimit_wait_seconds', 'Time callers waited in the rate limiter.',
+    ('bot',), buckets=(0, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+polling_batch_size = Histogram(
+    'polling_batch_size', 'Updates returned by one getUpdates call.',
+    ('bot',), buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+duplicate_updates_total = Counter(
+    'duplicate_updates_total', 'Redelivered updates that were dropped.',
+    ('bot',))
+shard_updates_total = Counter(
+    'shard_updates_total', 'Updates by owning shard and route.',
+    ('shard', 'route'))
+keyboard_bytes_saved_total = Counter(
+    'keyboard_bytes_saved_total',
+    'Request bytes saved by leaving out unchanged keyboards.', ('bot',))
+telegram_retries_total = Counter(
+    'telegram_retries_total', 'Bot API calls retried after a 429.',
+    ('bot', 'method'))
+query_budget_exceeded_total = Counter(
+    'query_budget_exceeded_total', 'Updates whose handler ran more SQL '
+    'statements than its max_queries.', ('handler',))
+telegram_skipped_total = Counter(
+    'telegram_skipped_total', 'Bot API calls not made because they would '
+    'fail.', ('bot', 'reason'))
+ratelimit_backend_seconds = Histogram(
+    'ratelimit_backend_seconds', 'Time one rate limit backend call took.',
+    ('backend',), buckets=(.00001, .00005, .0001, .0005, .001, .005, .01,
+                           .05, .1))
@@ -1,8 +1,51 @@
+from collections import namedtuple
+from os import environ
 from typing import List
 from typing import Optional
 from typing import Union
 
+from sqlalchemy.dialects.postgresql import insert
+
 from app import db
+from app.cache import LRUCache
+from app.cache import MISSING
+from app.metrics import bot_label
+from app.replica import read_query
+
+BOT_CACHE_SIZE = int(environ.get('BOT_CACHE_SIZE', 10000))
+# ChildBot.invalidate() only reaches the process it runs in. A bot that
+# another worker or node just looked up in vain stays unknown there for
+# up to BOT_NEGATIVE_TTL seconds after it was registered, and its first
+# updates in that time are dropped, so keep this short.
+BOT_NEGATIVE_TTL = float(environ.get('BOT_NEGATIVE_TTL', 5))
+
+CONFIG_VERSION_TTL = float(environ.get('CONFIG_VERSION_TTL', 2))
+
+BotInfo = namedtuple('BotInfo', ('id', 'admin', 'token'))
+
+# The version is stored in child_bots, so an edit made through any worker
+# or node moves every process on to new keyboards. A process re-reads it
+# at most every CONFIG_VERSION_TTL seconds, the one that made the edit at
+# once.
+_config_versions = LRUCache(BOT_CACHE_SIZE)
+
+
+def config_version(bot_id: int) -> int:
+    version = _config_versions.get(bot_id)
+    if version is MISSING:
+        version = db.session.query(ChildBot.config_version).filter(
+            ChildBot.id == bot_id).scalar() or 0
+        _config_versions.set(bot_id, version, CONFIG_VERSION_TTL)
+    return version
+
+
+def bump_config_version(bot_id: int):
+    # Part of the caller's transaction, so the new version is committed
+    # together with the rows it describes.
+    db.session.execute(ChildBot.__table__.update().where(
+        ChildBot.id == bot_id,
+    ).values(config_version=ChildBot.config_version + 1))
+    _config_versions.pop(bot_id)
 
 
 class ChildBot(db.Model):
@@ -11,43 +54,83 @@ class ChildBot(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     admin = db.Column(db.Integer)
     token = db.Column(db.String, unique=True)
+    config_version = db.Column(db.Integer, nullable=False, default=0,
+                               server_default='0')
+
+    registry = LRUCache(BOT_CACHE_SIZE)
 
     @classmethod
-    def get_by_token(cls, token: str) -> Optional['ChildBot']:
-        return cls.query.filter(cls.token == token).first()
+    def get_by_token(cls, token: str) -> Optional[BotInfo]:
+        bot = cls.registry.get(token)
+        if bot is not MISSING:
+            return bot
+
+        row = db.session.query(cls.id, cls.admin, cls.token).filter(
+            cls.token == token).first()
+        if row is None:
+            cls.registry.set(token, None, BOT_NEGATIVE_TTL)
+            return None
+
+        bot = BotInfo(*row)
+        cls.registry.set(token, bot)
+        return bot
+
+    @classmethod
+    def invalidate(cls, token: str):
+        cls.registry.pop(token)
+
+
+def known_bot_label(bot_token: str) -> str:
+    # Tokens in webhook paths are untrusted, so only the control bot and
+    # bots that passed the registry lookup get a label of their own; the
+    # rest share one. Updates this node forwards to another shard never
+    # reach the lookup here and count as unknown too.
+    if bot_token == environ['TELEGRAM_TOKEN'] or \
+            isinstance(ChildBot.registry.peek(bot_token), BotInfo):
+        return bot_label(bot_token)
+    return bot_label('unknown')
 
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_tg_id_bot_id', 'tg_id', 'bot_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     tg_id = db.Column(db.Integer)
     bot_id = db.Column(db.Integer, db.ForeignKey('child_bots.id'))
     menu_path = db.Column(db.String)
+    blocked = db.Column(db.Boolean, nullable=False, default=False,
+                        server_default=db.false())
 
     @classmethod
     def get_user(cls, bot_pointer: Union[int, str], user_id: int) -> 'User':
         if isinstance(bot_pointer, str):
             bot_pointer = ChildBot.get_by_token(bot_pointer).id
 
-        user = cls.query.filter(
+        query = cls.query.filter(
             cls.tg_id == user_id,
             cls.bot_id == bot_pointer,
-        ).first()
+        )
+        user = query.first()
 
         if user is None:
-            user = User()
-            user.tg_id = user_id
-            user.bot_id = bot_pointer
-
-            db.session.add(user)
+            db.session.execute(insert(cls.__table__).values(
+                tg_id=user_id,
+                bot_id=bot_pointer,
+            ).on_conflict_do_nothing(index_elements=['tg_id', 'bot_id']))
             db.session.commit()
+            user = query.first()
 
         return user
 
 
 class Menu(db.Model):
     __tablename__ = 'menus'
+    __table_args__ = (
+        db.Index('ix_menus_bot_id_name', 'bot_id', 'name', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     bot_id = db.Column(db.Integer, db.ForeignKey('child_bots.id'))
@@ -56,22 +139,27 @@ class Menu(db.Model):
     buttons = db.relationship('Button', backref='menus')
 
     @classmethod
-    def get_menu(cls, bot_pointer: Union[int, str], name: str) -> 'Menu':
+    def get_menu(cls, bot_pointer: Union[int, str], name: str,
+                 with_buttons: bool = False) -> 'Menu':
         if isinstance(bot_pointer, str):
             bot_pointer = ChildBot.get_by_token(bot_pointer).id
 
-        menu = cls.query.filter(
+        query = cls.query.filter(
             cls.bot_id == bot_pointer,
             cls.name == name,
-        ).first()
+        )
+        if with_buttons:
+            query = query.options(db.joinedload(cls.buttons))
+        menu = query.first()
 
         if menu is None:
-            menu = Menu()
-            menu.bot_id = bot_pointer
-            menu.name = name
-
-            db.session.add(menu)
+            db.session.execute(insert(cls.__table__).values(
+                bot_id=bot_pointer,
+                name=name,
+            ).on_conflict_do_nothing(index_elements=['bot_id', 'name']))
+            bump_config_version(bot_pointer)
             db.session.commit()
+            menu = query.first()
 
         return menu
 
@@ -80,11 +168,14 @@ class Menu(db.Model):
         if isinstance(bot_pointer, str):
             bot_pointer = ChildBot.get_by_token(bot_pointer).id
 
-        return cls.query.filter(cls.bot_id == bot_pointer).all()
+        return read_query(cls).filter(cls.bot_id == bot_pointer).all()
 
 
 class Button(db.Model):
     __tablename__ = 'buttons'
+    __table_args__ = (
+        db.Index('ix_buttons_menu_id_text', 'menu_id', 'text'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     menu_id = db.Column(db.Integer, db.ForeignKey('menus.id'))
@@ -92,9 +183,22 @@ class Button(db.Model):
     action_type = db.Column(db.String)
     action_name = db.Column(db.String)
 
+    @classmethod
+    def find(cls, bot_id: int, menu_name: str,
+             text: str) -> Optional['Button']:
+        return read_query(cls).join(Menu, cls.menu_id == Menu.id).filter(
+            Menu.bot_id == bot_id,
+            Menu.name == menu_name,
+            cls.text == text,
+        ).first()
+
 
 class Action(db.Model):
     __tablename__ = 'actions'
+    __table_args__ = (
+        db.Index('ix_actions_bot_id_name_order', 'bot_id', 'name', 'order',
+                 unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     bot_id = db.Column(db.Integer, db.ForeignKey('child_bots.id'))
@@ -110,4 +214,58 @@ class Action(db.Model):
         if isinstance(bot_pointer, str):
             bot_pointer = ChildBot.get_by_token(bot_pointer).id
 
-        return cls.query.filter(cls.bot_id == bot_pointer).all()
+        return read_query(cls).filter(cls.bot_id == bot_pointer).all()
+
+
+class Broadcast(db.Model):
+    __tablename__ = 'broadcasts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    bot_id = db.Column(db.Integer, db.ForeignKey('child_bots.id'))
+    text = db.Column(db.String)
+    last_user_id = db.Column(db.Integer, default=0)
+    sent = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    finished = db.Column(db.Boolean, default=False)
+
+
+class PollingOffset(db.Model):
+    __tablename__ = 'polling_offsets'
+
+    # The numeric prefix of the token, which also covers the control bot.
+    bot_key = db.Column(db.BigInteger, primary_key=True)
+    next_update_id = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def get(cls, bot_key: int) -> int:
+        row = db.session.query(cls.next_update_id).filter(
+            cls.bot_key == bot_key).first()
+        return row[0] if row else 0
+
+    @classmethod
+    def set(cls, bot_key: int, next_update_id: int):
+        statement = insert(cls.__table__).values(
+            bot_key=bot_key, next_update_id=next_update_id)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['bot_key'],
+            set_={'next_update_id': statement.excluded.next_update_id},
+        ))
+        db.session.commit()
+
+
+class ProcessedUpdate(db.Model):
+    __tablename__ = 'processed_updates'
+
+    bot_key = db.Column(db.BigInteger, primary_key=True)
+    update_id = db.Column(db.BigInteger, primary_key=True)
+    seen_at = db.Column(db.DateTime, server_default=db.func.now(),
+                        index=True)
+
+
+class RateLimitBucket(db.Model):
+    __tablename__ = 'rate_limit_buckets'
+
+    key = db.Column(db.String, primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    # Seconds since the epoch on the database clock.
+    updated = db.Column(db.Float, nullable=False, index=True)
@@ -0,0 +1,170 @@
+import sys
+import time
+import traceback
+from json import dumps
+from os import environ
+from queue import Queue
+from threading import Lock
+from threading import Thread
+from threading import Timer
+from typing import Set
+
+from app import app
+from app import db
+from app.client import TELEGRAM_API_URL
+from app.client import TELEGRAM_TIMEOUT
+from app.client import TelegramClient
+from app.metrics import bot_label
+from app.metrics import polling_batch_size
+from app.model import ChildBot
+from app.model import PollingOffset
+from app.routes import handle_webhook_update
+from app.sharding import sharding
+from app.telegram import INGRESS_MODE
+from app.telegram import WEBHOOK_ALLOWED_UPDATES
+
+POLLING_WORKERS = int(environ.get('POLLING_WORKERS', 32))
+POLLING_TIMEOUT = int(environ.get('POLLING_TIMEOUT', 25))
+POLLING_LIMIT = int(environ.get('POLLING_LIMIT', 100))
+POLLING_REFRESH = float(environ.get('POLLING_REFRESH', 60))
+POLLING_RETRY = float(environ.get('POLLING_RETRY', 5))
+
+
+class Poller:
+    # Bots take turns on a fixed set of workers. With at least as many
+    # workers as bots every bot is long-polled all the time. With fewer, a
+    # worker stays on an idle bot for up to POLLING_TIMEOUT seconds, so an
+    # update can wait about (bots / POLLING_WORKERS) * POLLING_TIMEOUT
+    # seconds for its bot's turn: 25 s with 64 bots on the default 32
+    # workers. Raise POLLING_WORKERS to the number of bots on this shard,
+    # or lower POLLING_TIMEOUT so that idle bots give their worker up
+    # sooner.
+    def __init__(self, workers: int, timeout: int, limit: int):
+        self.workers = workers
+        self.timeout = timeout
+        self.limit = limit
+        self.client = TelegramClient(TELEGRAM_API_URL, workers,
+                                     timeout + TELEGRAM_TIMEOUT)
+        self._queue = Queue()
+        self._tokens = set()
+        self._offsets = {}
+        self._lock = Lock()
+
+    def start(self):
+        for _ in range(self.workers):
+            Thread(target=self._work, daemon=True).start()
+
+    def _load_tokens(self) -> Set[str]:
+        with app.app_context():
+            tokens = {token for token, in db.session.query(ChildBot.token)}
+        tokens.add(environ['TELEGRAM_TOKEN'])
+        return {token for token in tokens if sharding.is_local(token)}
+
+    def refresh(self):
+        tokens = self._load_tokens()
+        with self._lock:
+            added = tokens - self._tokens
+            self._tokens = tokens
+        for bot_token in added:
+            self._queue.put(bot_token)
+        if added:
+            print(f'Polling {len(tokens)} bots, {len(added)} new')
+            if len(tokens) > self.workers:
+                print(f'{len(tokens)} bots share {self.workers} polling '
+                      f'workers, updates may wait up to '
+                      f'{len(tokens) / self.workers * self.timeout:.0f} s')
+
+    def _work(self):
+        while True:
+            bot_token = self._queue.get()
+            with self._lock:
+                if bot_token not in self._tokens:
+                    continue
+
+            with app.app_context():
+                try:
+                    again = self._poll(bot_token)
+                except Exception:
+                    traceback.print_exc()
+                    db.session.rollback()
+                    again = False
+                finally:
+                    db.session.remove()
+
+            if again:
+                self._queue.put(bot_token)
+            else:
+                Timer(POLLING_RETRY, self._queue.put, (bot_token,)).start()
+
+    def _prepare(self, bot_token: str) -> bool:
+        # getUpdates is refused while a webhook is set.
+        response = self.client.call(bot_token, 'deleteWebhook')
+        if not response['ok']:
+            print(response)
+            return False
+
+        offset = PollingOffset.get(int(bot_token.split(':')[0]))
+        db.session.commit()
+        self._offsets[bot_token] = offset
+        return True
+
+    def _poll(self, bot_token: str) -> bool:
+        if bot_token not in self._offsets and not self._prepare(bot_token):
+            return False
+
+        offset = self._offsets[bot_token]
+        response = self.client.call(bot_token, 'getUpdates', {
+            'offset': offset,
+            'limit': self.limit,
+            'timeout': self.timeout,
+            'allowed_updates': dumps(WEBHOOK_ALLOWED_UPDATES),
+        })
+        if not response['ok']:
+            print(response)
+            if response.get('error_code') == 409:
+                # Somebody set a webhook again, remove it on the next turn.
+                self._offsets.pop(bot_token, None)
+            return False
+
+        updates = response['result']
+        polling_batch_size.observe(len(updates), bot_label(bot_token))
+
+        next_update_id = offset
+        try:
+            for update in updates:
+                try:
+                    _, status = handle_webhook_update(bot_token, update,
+                                                      can_reply=False)
+                except Exception:
+                    # A broken update is skipped so it cannot stall the bot.
+                    traceback.print_exc()
+                    db.session.rollback()
+                    status = 200
+                if status == 503:
+                    break
+                next_update_id = update['update_id'] + 1
+        finally:
+            if next_update_id != offset:
+                # Stored once per batch; a crash mid-batch replays the rest.
+                PollingOffset.set(int(bot_token.split(':')[0]),
+                                  next_update_id)
+                self._offsets[bot_token] = next_update_id
+
+        # Only a full update pool stops a batch early, back off then.
+        return not updates or next_update_id > updates[-1]['update_id']
+
+
+def run_polling():
+    if INGRESS_MODE != 'polling':
+        # Polling deletes the webhooks the web process depends on.
+        print(f'INGRESS_MODE is {INGRESS_MODE!r}, set it to polling to poll')
+        sys.exit(1)
+
+    poller = Poller(POLLING_WORKERS, POLLING_TIMEOUT, POLLING_LIMIT)
+    poller.start()
+    while True:
+        try:
+            poller.refresh()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(POLLING_REFRESH)
@@ -0,0 +1,46 @@
+import time
+from contextlib import contextmanager
+from threading import local
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.tracing import record_span
+
+_local = local()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(connection, cursor, statement, parameters, context,
+                 executemany):
+    connection.info['query_started'] = time.perf_counter()
+    for counter in getattr(_local, 'counters', ()):
+        counter.count += 1
+        counter.statements.append(statement)
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_query(connection, cursor, statement, parameters, context,
+                executemany):
+    elapsed = time.perf_counter() - connection.info['query_started']
+    for counter in getattr(_local, 'counters', ()):
+        counter.seconds += elapsed
+    record_span('sql', elapsed, statement=statement, executemany=executemany)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    counters = _local.__dict__.setdefault('counters', [])
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
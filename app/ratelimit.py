@@ -0,0 +1,283 @@
+import fcntl
+import mmap
+import os
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+from itertools import count
+from os import environ
+from struct import Struct
+from threading import Lock
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+from app import engine_options
+from app.metrics import ratelimit_backend_seconds
+
+BOT_RATE = float(environ.get('RATE_LIMIT_BOT', 30))
+PRIVATE_CHAT_RATE = float(environ.get('RATE_LIMIT_PRIVATE_CHAT', 1))
+GROUP_CHAT_RATE = float(environ.get('RATE_LIMIT_GROUP_CHAT', 20 / 60))
+GROUP_CHAT_BURST = float(environ.get('RATE_LIMIT_GROUP_BURST', 20))
+RATE_LIMIT_BACKEND = environ.get('RATE_LIMIT_BACKEND', 'local')
+MAX_BUCKETS = int(environ.get('RATE_LIMIT_MAX_BUCKETS', 100000))
+SHM_PATH = environ.get('RATE_LIMIT_SHM_PATH', '/dev/shm/bot-ratelimit')
+SHM_SLOTS = int(environ.get('RATE_LIMIT_SHM_SLOTS', 65536))
+PRUNE_EVERY = int(environ.get('RATE_LIMIT_PRUNE_EVERY', 10000))
+PRUNE_AGE = float(environ.get('RATE_LIMIT_PRUNE_AGE', 3600))
+MAX_STATS = int(environ.get('RATE_LIMIT_MAX_STATS', 10000))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        # Takes one token, possibly going into debt, and returns how long
+        # the caller has to sleep before its token becomes valid. Sleeping
+        # happens outside of the lock so other senders are never blocked.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate,
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class LocalBackend:
+    # Buckets in this process only, each worker enforces the limits on its
+    # own.
+    name = 'local'
+
+    def __init__(self, size: int):
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def reserve(self, key: str, rate: float, capacity: float) -> float:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, capacity)
+                if len(self._buckets) > self.size:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.reserve()
+
+
+class SharedMemoryBackend:
+    # Buckets in a memory-mapped file that every worker on the host maps.
+    # A key hashes to a window of PROBE slots; within it a bucket takes its
+    # own slot, an empty one, or one whose bucket is full again, which is
+    # the same as not having it. Windows are locked with fcntl between
+    # processes and with a lock between the threads of one process, since
+    # fcntl locks belong to the process.
+    name = 'shm'
+
+    SLOT = Struct('<Qdddd')  # key hash, tokens, updated, rate, capacity
+    PROBE = 8
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = max(slots, self.PROBE)
+        self.evictions = 0
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _open(self):
+        # Opened per process, after gunicorn forked its workers.
+        size = self.slots * self.SLOT.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._map = mmap.mmap(fd, size)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def reserve(self, key: str, rate: float, capacity: float) -> float:
+        key_hash = int.from_bytes(
+            blake2b(key.encode(), digest_size=8).digest(), 'big') | 1
+        window = key_hash % (self.slots - self.PROBE + 1) * self.SLOT.size
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+
+            fcntl.lockf(self._fd, fcntl.LOCK_EX,
+                        self.PROBE * self.SLOT.size, window)
+            try:
+                now = time.monotonic()
+                offset = self._find(window, key_hash, now)
+                slot_hash, tokens, updated, _, _ = self.SLOT.unpack_from(
+                    self._map, offset)
+                if slot_hash != key_hash:
+                    tokens, updated = capacity, now
+                tokens = min(capacity,
+                             tokens + max(0.0, now - updated) * rate) - 1
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now,
+                                    rate, capacity)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN,
+                            self.PROBE * self.SLOT.size, window)
+
+        if tokens >= 0:
+            return 0.0
+        return -tokens / rate
+
+    def _find(self, window: int, key_hash: int, now: float) -> int:
+        free = None
+        for index in range(self.PROBE):
+            offset = window + index * self.SLOT.size
+            slot_hash, tokens, updated, rate, capacity = \
+                self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset
+            if free is None and (
+                    slot_hash == 0 or
+                    tokens + max(0.0, now - updated) * rate >= capacity):
+                free = offset
+
+        if free is None:
+            # Every bucket of the window is in use, the first one loses
+            # its debt.
+            self.evictions += 1
+            free = window
+        return free
+
+
+class PostgresBackend:
+    # Buckets in a table shared by every node. One upsert per bucket both
+    # refills and takes the token, so concurrent callers never lose an
+    # update; the database clock is the only clock involved.
+    name = 'postgres'
+
+    _RESERVE = text(
+        'INSERT INTO rate_limit_buckets AS bucket (key, tokens, updated) '
+        'VALUES (:key, :capacity - 1, extract(epoch FROM clock_timestamp())) '
+        'ON CONFLICT (key) DO UPDATE SET '
+        'tokens = least(:capacity, bucket.tokens + :rate * greatest(0, '
+        'extract(epoch FROM clock_timestamp()) - bucket.updated)) - 1, '
+        'updated = extract(epoch FROM clock_timestamp()) '
+        'RETURNING tokens'
+    )
+    _PRUNE = text(
+        'DELETE FROM rate_limit_buckets '
+        'WHERE updated < extract(epoch FROM clock_timestamp()) - :age'
+    )
+
+    def __init__(self, database_url: str, prune_every: int, prune_age: float):
+        self.database_url = database_url
+        self.prune_every = prune_every
+        self.prune_age = prune_age
+        self._calls = count(1)
+        self._engine = None
+        self._lock = Lock()
+
+    @property
+    def engine(self):
+        # A pool of its own, sized with RATE_LIMIT_DATABASE_POOL_SIZE and
+        # friends. A handler already holds a connection of the app's pool
+        # while it sends, so taking the limiter's connection from the same
+        # pool could leave every handler waiting for one that none of
+        # them gives back. A reserve holds its connection only for the
+        # upsert, so a handful per process is enough; count them in when
+        # sizing max_connections. Created on first use, after the fork.
+        with self._lock:
+            if self._engine is None:
+                self._engine = create_engine(
+                    self.database_url,
+                    **engine_options('RATE_LIMIT_DATABASE'))
+            return self._engine
+
+    def reserve(self, key: str, rate: float, capacity: float) -> float:
+        # A connection of its own, so the caller's transaction is neither
+        # committed nor held open by the limiter.
+        with self.engine.begin() as connection:
+            tokens = connection.execute(self._RESERVE, {
+                'key': key, 'rate': rate, 'capacity': capacity,
+            }).scalar()
+            if next(self._calls) % self.prune_every == 0:
+                connection.execute(self._PRUNE, {'age': self.prune_age})
+
+        if tokens >= 0:
+            return 0.0
+        return -tokens / rate
+
+
+def create_backend(name: str):
+    if name == 'local':
+        return LocalBackend(MAX_BUCKETS)
+    if name == 'shm':
+        return SharedMemoryBackend(SHM_PATH, SHM_SLOTS)
+    if name == 'postgres':
+        return PostgresBackend(environ['DATABASE_URL'], PRUNE_EVERY,
+                               PRUNE_AGE)
+    raise ValueError(f'Unknown rate limit backend {name}')
+
+
+class RateLimiter:
+    # Per-bot counters for /stats, the least recently used bot is dropped
+    # once there are stats_size of them.
+    def __init__(self, backend, stats_size: int):
+        self.backend = backend
+        self.stats_size = stats_size
+        self._stats = OrderedDict()
+        self._lock = Lock()
+
+    def _wait(self, key: str, rate: float, capacity: float) -> float:
+        started = time.perf_counter()
+        wait = self.backend.reserve(key, rate, capacity)
+        ratelimit_backend_seconds.observe(time.perf_counter() - started,
+                                          self.backend.name)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def acquire(self, bot_token: str, chat_id: Optional[int] = None) -> float:
+        bot_key = bot_token.split(':')[0]
+        waited = 0.0
+
+        if chat_id is not None:
+            if chat_id < 0:
+                waited += self._wait(f'{bot_key}:{chat_id}', GROUP_CHAT_RATE,
+                                     GROUP_CHAT_BURST)
+            else:
+                waited += self._wait(f'{bot_key}:{chat_id}',
+                                     PRIVATE_CHAT_RATE, 1)
+
+        waited += self._wait(bot_key, BOT_RATE, BOT_RATE)
+
+        with self._lock:
+            stats = self._stats.get(bot_key)
+            if stats is None:
+                stats = self._stats[bot_key] = [0, 0.0]
+                if len(self._stats) > self.stats_size:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(bot_key)
+            stats[0] += 1
+            stats[1] += waited
+        return waited
+
+    def stats(self) -> Dict[str, Tuple[int, float]]:
+        with self._lock:
+            return {bot: (calls, waited)
+                    for bot, (calls, waited) in self._stats.items()}
+
+
+limiter = RateLimiter(create_backend(RATE_LIMIT_BACKEND), MAX_STATS)
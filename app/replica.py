@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+from os import environ
+from threading import local
+
+from flask import g
+from flask import has_app_context
+from sqlalchemy import create_engine
+from sqlalchemy import event
+
+from app import app
+from app import db
+from app import engine_options
+
+DATABASE_REPLICA_URL = environ.get('DATABASE_REPLICA_URL')
+
+_local = local()
+
+
+def create_replica_session(engine):
+    # Flask-SQLAlchemy hands every session the per-table binds of the app,
+    # which take precedence over `bind`; without clearing them all model
+    # queries would still go to the primary.
+    return db.create_scoped_session({'bind': engine, 'binds': {}})
+
+
+if DATABASE_REPLICA_URL:
+    replica_engine = create_engine(DATABASE_REPLICA_URL,
+                                   **engine_options('DATABASE_REPLICA'))
+    replica_session = create_replica_session(replica_engine)
+else:
+    replica_engine = replica_session = None
+
+
+def _use_primary(follow_writes: bool) -> bool:
+    if getattr(_local, 'primary', 0):
+        return True
+    return follow_writes and has_app_context() and \
+        g.get('read_primary', False)
+
+
+def read_query(*entities, follow_writes: bool = True):
+    # Read-only lookups go to the replica, unless the current update has
+    # written something already: from then on it reads its own writes
+    # from the primary.
+    if replica_session is None or _use_primary(follow_writes):
+        return db.session.query(*entities)
+    return replica_session.query(*entities)
+
+
+@contextmanager
+def on_primary():
+    # For reads whose result outlives the update, like cached keyboards,
+    # which must not be built from a lagging replica.
+    _local.primary = getattr(_local, 'primary', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary -= 1
+
+
+# Only commits that wrote ORM rows switch the update to the primary.
+# Statements run with session.execute(), like dedup claims, polling offsets
+# and user upserts, touch no table that is read here, and a commit that
+# wrote nothing at all keeps the replica.
+@event.listens_for(db.session, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _bulk_written(context):
+    context.session.info['wrote'] = True
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('wrote', None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _read_own_writes(session):
+    if session.info.pop('wrote', False) and \
+            session.bind is not replica_engine and has_app_context():
+        g.read_primary = True
+
+
+if replica_session is not None:
+    @app.teardown_appcontext
+    def _remove_replica_session(exception):
+        replica_session.remove()
@@ -0,0 +1,124 @@
+import random
+import time
+from os import environ
+from threading import Lock
+from typing import Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+from app import engine_options
+from app.cache import LRUCache
+from app.cache import MISSING
+
+TELEGRAM_RETRIES = int(environ.get('TELEGRAM_RETRIES', 3))
+TELEGRAM_MAX_RETRY_AFTER = float(environ.get('TELEGRAM_MAX_RETRY_AFTER', 30))
+TELEGRAM_RETRY_JITTER = float(environ.get('TELEGRAM_RETRY_JITTER', 0.1))
+BREAKER_THRESHOLD = int(environ.get('BREAKER_THRESHOLD', 3))
+BREAKER_COOLDOWN = float(environ.get('BREAKER_COOLDOWN', 300))
+BREAKER_SIZE = int(environ.get('BREAKER_SIZE', 10000))
+BLOCKED_CHATS_SIZE = int(environ.get('BLOCKED_CHATS_SIZE', 100000))
+
+# Answers that mean the token itself is dead: revoked or never existed.
+_DEAD_TOKEN_CODES = (401, 404)
+
+
+def retry_delay(response: dict) -> Optional[float]:
+    if response.get('error_code') != 429:
+        return None
+
+    retry_after = response.get('parameters', {}).get('retry_after', 1)
+    if retry_after > TELEGRAM_MAX_RETRY_AFTER:
+        # Holding a worker that long is worse than dropping the message.
+        return None
+    # The jitter keeps the callers that were throttled together from all
+    # coming back in the same instant.
+    return retry_after * (1 + random.uniform(0, TELEGRAM_RETRY_JITTER))
+
+
+class CircuitBreaker:
+    # Opens for a token after `threshold` dead-token answers in a row.
+    # Once `cooldown` has passed a single call is let through again: an ok
+    # or any other answer closes the breaker, a dead-token answer keeps it
+    # open for another cooldown.
+    def __init__(self, threshold: int, cooldown: float, size: int):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = LRUCache(size)
+        self._opened = LRUCache(size)
+        self._lock = Lock()
+
+    def allow(self, bot_token: str) -> bool:
+        with self._lock:
+            opened = self._opened.get(bot_token)
+            if opened is MISSING:
+                return True
+            if time.monotonic() - opened < self.cooldown:
+                return False
+            self._opened.set(bot_token, time.monotonic())
+            return True
+
+    def record(self, bot_token: str, response: dict):
+        with self._lock:
+            if response['ok'] or \
+                    response.get('error_code') not in _DEAD_TOKEN_CODES:
+                self._failures.pop(bot_token)
+                self._opened.pop(bot_token)
+                return
+
+            failures = self._failures.get(bot_token)
+            failures = 1 if failures is MISSING else failures + 1
+            self._failures.set(bot_token, failures)
+            if failures >= self.threshold:
+                self._opened.set(bot_token, time.monotonic())
+
+    def open_count(self) -> int:
+        return len(self._opened)
+
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN, BREAKER_SIZE)
+blocked_chats = LRUCache(BLOCKED_CHATS_SIZE)
+
+
+_engine = None
+_engine_lock = Lock()
+
+
+def _blocked_engine():
+    # A pool of its own, sized with BLOCKED_CHATS_DATABASE_POOL_SIZE and
+    # friends: the handler marking a chat already holds a connection of the
+    # app's pool, and a burst of 403s must not wait for the rest of it.
+    # Created on first use, after the fork.
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(
+                environ['DATABASE_URL'],
+                **engine_options('BLOCKED_CHATS_DATABASE'))
+        return _engine
+
+
+def _chat_key(bot_token: str, chat_id: int) -> tuple:
+    return bot_token.split(':')[0], int(chat_id)
+
+
+def is_blocked(bot_token: str, chat_id: int) -> bool:
+    return blocked_chats.get(_chat_key(bot_token, chat_id)) is not MISSING
+
+
+def mark_blocked(bot_token: str, chat_id: int):
+    blocked_chats.set(_chat_key(bot_token, chat_id), True)
+    # A connection of its own, the caller's session may be in the middle
+    # of a transaction that must not be committed here.
+    with _blocked_engine().begin() as connection:
+        connection.execute(text(
+            'UPDATE users SET blocked = true '
+            'WHERE tg_id = :chat_id AND bot_id = '
+            '(SELECT id FROM child_bots WHERE token = :token)'
+        ), {'chat_id': int(chat_id), 'token': bot_token})
+
+
+def unblock_chat(bot_token: str, chat_id: int):
+    # The stored flag is cleared by the next UserStore.save(), which runs
+    # once a reply reached the chat.
+    blocked_chats.pop(_chat_key(bot_token, chat_id))
@@ -1,17 +1,48 @@
+import hmac
+import time
 from os import environ
-from re import match
+from re import compile
+from re import fullmatch
+from typing import Optional
+from typing import Tuple
 
+from flask import abort
+from flask import jsonify
 from flask import request
+from flask import send_from_directory
 from sqlalchemy.exc import IntegrityError
 
 from app import app
 from app import db
+from app.client import current_client
+from app.dedup import dedup
+from app.dispatcher import Dispatcher
+from app.dispatcher import Update
+from app.metrics import CallbackMetric
+from app.metrics import bot_label
+from app.metrics import render
+from app.metrics import shard_updates_total
+from app.metrics import update_db_queries
+from app.metrics import update_db_seconds
+from app.metrics import update_seconds
+from app.metrics import updates_total
+from app.metrics import webhook_seconds
 from app.model import ChildBot
-from app.model import User
+from app.model import known_bot_label
+from app.queries import count_queries
+from app.ratelimit import limiter
+from app.resilience import blocked_chats
+from app.resilience import breaker
+from app.resilience import unblock_chat
+from app.sharding import SHARD_FORWARDED_HEADER
+from app.sharding import sharding
+from app.state import users
+from app.telegram import WEBHOOK_REPLY
 from app.telegram import add_button
 from app.telegram import add_menu
 from app.telegram import add_new_action
 from app.telegram import add_subaction
+from app.telegram import begin_webhook_reply
 from app.telegram import button_click
 from app.telegram import send_actions_settings_menu
 from app.telegram import send_add_action
@@ -22,30 +53,51 @@ from app.telegram import send_edit_menu
 from app.telegram import send_menu_settings
 from app.telegram import send_message
 from app.telegram import check_bot_token
+from app.telegram import end_webhook_reply
+from app.telegram import forget_keyboard
+from app.telegram import keyboards
 from app.telegram import set_up_webhook
 from app.telegram import send_settings_menu
 from app.telegram import send_previous_menu
 from app.telegram import send_start_message
+from app.tracing import TRACE_DIR
+from app.tracing import TRACE_HEADER
+from app.tracing import is_trace_key
+from app.tracing import list_traces
+from app.tracing import should_trace
+from app.tracing import tracing
+from app.transfer import CONFIG_KEY
+from app.transfer import CONFIG_KEY_HEADER
+from app.transfer import export_bot
+from app.transfer import import_bot
+from app.worker import UPDATE_QUEUE_SIZE
+from app.worker import UPDATE_WORKER_KIND
+from app.worker import UPDATE_WORKERS
+from app.worker import UpdatePool
 
+# The control bot has no child_bots row, ids there start at 1.
+CONTROL_BOT_ID = 0
 
-def get_control_bot(bot_token: str):
+
+def get_control_bot(update: dict, bot_token: str):
     child_bot = ChildBot()
-    child_bot.admin = request.json['message']['from']['id']
+    child_bot.admin = update['message']['from']['id']
     child_bot.token = bot_token
     db.session.add(child_bot)
     try:
         db.session.commit()
+        ChildBot.invalidate(bot_token)
 
         set_up_webhook(bot_token)
 
-        chat_id = request.json['message']['chat']['id']
+        chat_id = update['message']['chat']['id']
         send_message(
             environ['TELEGRAM_TOKEN'],
             chat_id,
             'Теперь мы управляем Вашим ботом',
         )
     except IntegrityError:
-        chat_id = request.json['message']['chat']['id']
+        chat_id = update['message']['chat']['id']
         send_message(
             environ['TELEGRAM_TOKEN'],
             chat_id,
@@ -55,15 +107,15 @@ def get_control_bot(bot_token: str):
 
 
 def check_token(text: str) -> bool:
-    result = match(r'\d+:.+', text)
+    result = fullmatch(r'\d+:[A-Za-z0-9_-]+', text)
     if result:
         return check_bot_token(text)
     else:
         return False
 
 
-def start_admin(bot_token: str):
-    chat_id = request.json['message']['chat']['id']
+def start_admin(update: dict, bot_token: str):
+    chat_id = update['message']['chat']['id']
     send_message(
         bot_token,
         chat_id,
@@ -77,64 +129,368 @@ def check_access_settings(bot_token: str, user_id: int) -> bool:
     if bot.admin != user_id:
         return False
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu':
         return False
 
     return True
 
 
+dispatcher = Dispatcher()
+
+
+@dispatcher.route(text='/start', max_queries=2)
+def _start(update: Update):
+    send_start_message(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(text='Настройки')
+def _settings(update: Update):
+    if check_access_settings(update.bot_token, update.user_id):
+        send_settings_menu(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(text='Настройки меню')
+def _menu_settings(update: Update):
+    send_menu_settings(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(text='Добавить меню')
+def _add_menu_menu(update: Update):
+    send_add_menu_menu(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(text='Назад', max_queries=2)
+def _previous_menu(update: Update):
+    send_previous_menu(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(state='_start_menu/_settings/_menus/_add_menu')
+def _add_menu(update: Update):
+    add_menu(update.bot_token, update.chat_id, update.user_id, update.text)
+
+
+@dispatcher.route(state='_start_menu/_settings/_menus',
+                  text=compile(r'\s*Редактировать\s+\S+\s+меню(\s|$)'))
+def _edit_menu(update: Update):
+    send_edit_menu(update.bot_token, update.chat_id, update.user_id,
+                   update.text)
+
+
+@dispatcher.route(state='_start_menu/_settings/_menus/**',
+                  text='Добавить кнопку')
+def _add_button_menu(update: Update):
+    send_add_button_menu(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(state='_start_menu/_settings/_menus/**/_add_button')
+def _add_button(update: Update):
+    add_button(update.bot_token, update.chat_id, update.user_id,
+               update.text)
+
+
+@dispatcher.route(state='_start_menu/_settings', text='Настройки действий')
+def _actions_settings(update: Update):
+    send_actions_settings_menu(update.bot_token, update.chat_id,
+                               update.user_id)
+
+
+@dispatcher.route(state='_start_menu/_settings/_actions',
+                  text='Добавить действие')
+def _add_action(update: Update):
+    send_add_action(update.bot_token, update.chat_id, update.user_id)
+
+
+@dispatcher.route(state='_start_menu/_settings/_actions/_add_action')
+def _add_new_action(update: Update):
+    add_new_action(update.bot_token, update.chat_id, update.user_id,
+                   update.text)
+
+
+@dispatcher.route(state='_start_menu/_settings/_actions')
+def _edit_action(update: Update):
+    send_edit_action_menu(update.bot_token, update.chat_id, update.user_id,
+                          update.text)
+
+
+@dispatcher.route(state='_start_menu/_settings/_actions/**')
+def _add_subaction(update: Update):
+    add_subaction(update.bot_token, update.chat_id, update.user_id,
+                  update.text)
+
+
+@dispatcher.default(max_queries=2)
+def _button_click(update: Update):
+    button_click(update.bot_token, update.chat_id, update.user_id,
+                 update.text)
+
+
+def _handle_update(bot_token: str, update: dict):
+    text = update['message']['text']
+    chat_id = update['message']['chat']['id']
+    user_id = update['message']['from']['id']
+    # Whoever writes to the bot has not blocked it (any more).
+    unblock_chat(bot_token, chat_id)
+    if bot_token == environ['TELEGRAM_TOKEN']:
+        updates_total.inc(bot_label(bot_token), 'admin')
+        if text == '/start':
+            start_admin(update, bot_token)
+        if check_token(text):
+            get_control_bot(update, text)
+    else:
+        if text == '/start':
+            # The user may have cleared the chat, keyboard included.
+            forget_keyboard(bot_token, chat_id)
+        user = users.load(bot_token, user_id)
+        path = tuple(user.menu_path.split('/')) if user.menu_path else ()
+        dispatcher.dispatch(
+            Update(bot_token, chat_id, user_id, text, user, path))
+
+
+def process_update(bot_token: str, update: dict, trace: bool = False):
+    bot = bot_label(bot_token)
+    started = time.perf_counter()
+    with tracing(bot, trace), count_queries() as queries:
+        _handle_update(bot_token, update)
+    update_seconds.observe(time.perf_counter() - started, bot)
+    update_db_seconds.observe(queries.seconds, bot)
+    update_db_queries.observe(queries.count, bot)
+
+
+pool = UpdatePool(process_update, UPDATE_WORKERS, UPDATE_WORKER_KIND,
+                  UPDATE_QUEUE_SIZE)
+
+
 @app.route('/webhook/<bot_token>', methods=['POST'])
 def webhook(bot_token: str):
-    print(request.json)
+    started = time.perf_counter()
     try:
-        text = request.json['message']['text']
-    except KeyError:
-        return ''
-    chat_id = request.json['message']['chat']['id']
-    user_id = request.json['message']['from']['id']
+        return _answer_webhook(bot_token)
+    finally:
+        webhook_seconds.observe(time.perf_counter() - started,
+                                known_bot_label(bot_token))
+
+
+def _answer_webhook(bot_token: str):
+    update = request.json
+    print(update)
+    # The sampling decision is made once here and travels with the update,
+    # so a traced update stays traced on whichever worker runs it.
+    trace = should_trace(request.headers.get(TRACE_HEADER))
+    forwarded = SHARD_FORWARDED_HEADER in request.headers
+    reply, status = handle_webhook_update(bot_token, update, trace,
+                                          forwarded=forwarded)
+    if reply is None:
+        return '', status
+    return jsonify(reply)
+
+
+def handle_webhook_update(bot_token: str, update: dict, trace: bool = False,
+                          can_reply: bool = True, forwarded: bool = False
+                          ) -> Tuple[Optional[dict], int]:
+    if 'text' not in update.get('message', {}):
+        return None, 200
+
+    if sharding.enabled:
+        # An update that was forwarded once is kept even if the shard
+        # lists disagree, so it cannot bounce between nodes.
+        if not forwarded and not sharding.is_local(bot_token):
+            return sharding.forward(bot_token, update, trace)
+        shard_updates_total.inc(sharding.shard_id, 'local')
+
     if bot_token == environ['TELEGRAM_TOKEN']:
-        if text == '/start':
-            start_admin(bot_token)
-        if check_bot_token(text):
-            get_control_bot(text)
+        bot_id = CONTROL_BOT_ID
     else:
-        user = User.get_user(bot_token, user_id)
-        if text == '/start':
-            send_start_message(bot_token, chat_id, user_id)
-        elif text == 'Настройки':
-            if check_access_settings(bot_token, user_id):
-                send_settings_menu(bot_token, chat_id, user_id)
-        elif text == 'Настройки меню':
-            send_menu_settings(bot_token, chat_id, user_id)
-        elif text == 'Добавить меню':
-            send_add_menu_menu(bot_token, chat_id, user_id)
-        elif text == 'Назад':
-            send_previous_menu(bot_token, chat_id, user_id)
-        elif user.menu_path == '_start_menu/_settings/_menus/_add_menu':
-            add_menu(bot_token, chat_id, user_id, text)
-        elif user.menu_path == '_start_menu/_settings/_menus' and \
-                text.split()[0] == 'Редактировать' and \
-                text.split()[2] == 'меню':
-            send_edit_menu(bot_token, chat_id, user_id, text)
-        elif user.menu_path.startswith('_start_menu/_settings/_menus/') and \
-                text == 'Добавить кнопку':
-            send_add_button_menu(bot_token, chat_id, user_id)
-        elif user.menu_path.startswith('_start_menu/_settings/_menus/') and \
-                user.menu_path.split('/')[-1] == '_add_button':
-            add_button(bot_token, chat_id, user_id, text)
-        elif user.menu_path == '_start_menu/_settings' and \
-                text == 'Настройки действий':
-            send_actions_settings_menu(bot_token, chat_id, user_id)
-        elif user.menu_path == '_start_menu/_settings/_actions' and \
-                text == 'Добавить действие':
-            send_add_action(bot_token, chat_id, user_id)
-        elif user.menu_path == '_start_menu/_settings/_actions/_add_action':
-            add_new_action(bot_token, chat_id, user_id, text)
-        elif user.menu_path == '_start_menu/_settings/_actions':
-            send_edit_action_menu(bot_token, chat_id, user_id, text)
-        elif user.menu_path.startswith('_start_menu/_settings/_actions/'):
-            add_subaction(bot_token, chat_id, user_id, text)
-        else:
-            button_click(bot_token, chat_id, user_id, text)
-    return ''
+        bot = ChildBot.get_by_token(bot_token)
+        if bot is None:
+            return None, 200
+        bot_id = bot.id
+
+    # Redeliveries are dropped before any other work on the update. One
+    # that was not handled is forgotten again so that Telegram's retry
+    # gets through.
+    update_id = update.get('update_id')
+    if not dedup.first_seen(bot_id, update_id, bot_label(bot_token)):
+        return None, 200
+    try:
+        reply, status = _accept_update(bot_token, update, trace, can_reply)
+    except Exception:
+        dedup.forget(bot_id, update_id)
+        raise
+    if status != 200:
+        dedup.forget(bot_id, update_id)
+    return reply, status
+
+
+def _accept_update(bot_token: str, update: dict, trace: bool,
+                   can_reply: bool) -> Tuple[Optional[dict], int]:
+    if pool.enabled:
+        if not pool.submit(bot_token, update, trace):
+            # Telegram redelivers the update later, which is exactly the
+            # back pressure we want while the queue is full.
+            return None, 503
+        return None, 200
+
+    if not WEBHOOK_REPLY or not can_reply:
+        process_update(bot_token, update, trace)
+        return None, 200
+
+    begin_webhook_reply(bot_token)
+    try:
+        process_update(bot_token, update, trace)
+    finally:
+        reply = end_webhook_reply()
+    return reply, 200
+
+
+def _check_config_key():
+    key = request.headers.get(CONFIG_KEY_HEADER, '')
+    if not CONFIG_KEY or \
+            not hmac.compare_digest(key.encode(), CONFIG_KEY.encode()):
+        abort(404)
+
+
+@app.route('/bots/<bot_token>/config', methods=['GET'])
+def export_config(bot_token: str):
+    _check_config_key()
+    bot = ChildBot.get_by_token(bot_token)
+    if bot is None:
+        return '', 404
+    return jsonify(export_bot(bot.id))
+
+
+@app.route('/bots/<bot_token>/config', methods=['PUT'])
+def import_config(bot_token: str):
+    _check_config_key()
+    bot = ChildBot.get_by_token(bot_token)
+    if bot is None:
+        return '', 404
+
+    try:
+        import_bot(bot.id, request.get_json(force=True))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return '', 204
+
+
+def _check_trace_key():
+    # Traces contain SQL and chat ids, so they are only served to whoever
+    # knows TRACE_KEY and not at all without one. The key is sent in the
+    # same header that forces a trace, query strings end up in access logs.
+    if not is_trace_key(request.headers.get(TRACE_HEADER)):
+        abort(404)
+
+
+@app.route('/traces', methods=['GET'])
+def traces():
+    _check_trace_key()
+    return jsonify(list_traces())
+
+
+@app.route('/traces/<name>', methods=['GET'])
+def download_trace(name: str):
+    _check_trace_key()
+    if name not in list_traces():
+        abort(404)
+    return send_from_directory(TRACE_DIR, name,
+                               mimetype='application/json')
+
+
+@app.route('/shards', methods=['GET'])
+def shards():
+    tokens = [environ['TELEGRAM_TOKEN']]
+    tokens.extend(token for token, in db.session.query(ChildBot.token))
+
+    bots = dict.fromkeys(sharding.shards, 0)
+    for token in tokens:
+        owner = sharding.owner(token)
+        if owner is not None:
+            bots[owner] += 1
+
+    return jsonify({
+        'shard_id': sharding.shard_id,
+        'shards': {
+            name: {'url': url, 'bots': bots[name]}
+            for name, url in sharding.shards.items()
+        },
+    })
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'bot_cache': {
+            'size': len(ChildBot.registry),
+            'hits': ChildBot.registry.hits,
+            'misses': ChildBot.registry.misses,
+        },
+        'http': current_client().stats(),
+        'keyboard_cache': {
+            'size': len(keyboards),
+            'hits': keyboards.hits,
+            'misses': keyboards.misses,
+        },
+        'user_state': {
+            'write_behind': users.write_behind,
+            'pending': users.depth(),
+            'flushed': users.flushed,
+        },
+        'rate_limit': {
+            bot: {'calls': calls, 'waited': waited}
+            for bot, (calls, waited) in limiter.stats().items()
+        },
+        'resilience': {
+            'open_breakers': breaker.open_count(),
+            'blocked_chats': len(blocked_chats),
+        },
+        'queue': {
+            'depth': pool.depth(),
+            'lanes': pool.lane_depths(),
+            'size': pool.size,
+            'workers': pool.workers,
+            'kind': pool.kind,
+        },
+    })
+
+
+CallbackMetric(
+    'cache_hits_total', 'Cache hits.', 'counter', ('cache',),
+    lambda: {('bots',): ChildBot.registry.hits,
+             ('keyboards',): keyboards.hits},
+)
+CallbackMetric(
+    'cache_misses_total', 'Cache misses.', 'counter', ('cache',),
+    lambda: {('bots',): ChildBot.registry.misses,
+             ('keyboards',): keyboards.misses},
+)
+
+
+def _connection_counts() -> dict:
+    counts = current_client().stats()
+    return {('new',): counts['new_connections'],
+            ('reused',): counts['reused_connections']}
+
+
+CallbackMetric(
+    'telegram_connections_total', 'Connections to the Bot API.', 'counter',
+    ('kind',), _connection_counts,
+)
+CallbackMetric(
+    'update_queue_depth', 'Updates waiting for a worker.', 'gauge', (),
+    lambda: {(): pool.depth()},
+)
+CallbackMetric(
+    'update_lane_depth', 'Updates waiting in each worker lane.', 'gauge',
+    ('lane',),
+    lambda: {(str(lane),): depth
+             for lane, depth in enumerate(pool.lane_depths())},
+)
+CallbackMetric(
+    'user_state_pending', 'User states waiting to be flushed.', 'gauge', (),
+    lambda: {(): users.depth()},
+)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -0,0 +1,99 @@
+from bisect import bisect
+from hashlib import md5
+from os import environ
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from app.metrics import shard_updates_total
+from app.tracing import TRACE_HEADER
+from app.tracing import TRACE_KEY
+
+SHARDS = environ.get('SHARDS', '')
+SHARD_ID = environ.get('SHARD_ID', '')
+SHARD_VNODES = int(environ.get('SHARD_VNODES', 100))
+SHARD_FORWARD_TIMEOUT = float(environ.get('SHARD_FORWARD_TIMEOUT', 30))
+SHARD_FORWARDED_HEADER = 'X-Shard-Forwarded'
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    # Every node gets `replicas` points on the ring and a key belongs to
+    # the first point after its hash, so adding a node only takes over
+    # about 1/N of the keys.
+    def __init__(self, nodes: List[str], replicas: int):
+        points = sorted((_hash(f'{node}#{replica}'), node)
+                        for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key: str) -> Optional[str]:
+        if not self._nodes:
+            return None
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def _parse_shards(value: str) -> Dict[str, str]:
+    shards = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, url = item.split('=', 1)
+        shards[name.strip()] = url.strip().rstrip('/')
+    return shards
+
+
+class Sharding:
+    def __init__(self, shards: Dict[str, str], shard_id: str,
+                 replicas: int):
+        if shards and shard_id not in shards:
+            raise ValueError(f'SHARD_ID {shard_id!r} is not one of SHARDS')
+
+        self.shards = shards
+        self.shard_id = shard_id
+        self._ring = HashRing(sorted(shards), replicas)
+        self._session = Session()
+        self._session.mount('https://', HTTPAdapter(pool_maxsize=32))
+        self._session.mount('http://', HTTPAdapter(pool_maxsize=32))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shards)
+
+    def owner(self, bot_token: str) -> Optional[str]:
+        # Keyed by the bot id, which never changes for a bot.
+        return self._ring.node(bot_token.split(':')[0])
+
+    def is_local(self, bot_token: str) -> bool:
+        return not self.enabled or self.owner(bot_token) == self.shard_id
+
+    def url(self, bot_token: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        return self.shards[self.owner(bot_token)]
+
+    def forward(self, bot_token: str, update: dict,
+                trace: bool) -> Tuple[Optional[dict], int]:
+        owner = self.owner(bot_token)
+        shard_updates_total.inc(owner, 'forwarded')
+        headers = {SHARD_FORWARDED_HEADER: self.shard_id}
+        if trace and TRACE_KEY:
+            headers[TRACE_HEADER] = TRACE_KEY
+        response = self._session.post(
+            f'{self.shards[owner]}/webhook/{bot_token}',
+            json=update,
+            headers=headers,
+            timeout=SHARD_FORWARD_TIMEOUT,
+        )
+        if response.status_code != 200 or not response.content:
+            return None, response.status_code
+        return response.json(), 200
+
+
+sharding = Sharding(_parse_shards(SHARDS), SHARD_ID, SHARD_VNODES)
@@ -0,0 +1,219 @@
+import atexit
+import time
+import traceback
+from collections import OrderedDict
+from os import environ
+from os import getpid
+from threading import Lock
+from threading import Thread
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from flask import g
+from flask import has_app_context
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import insert
+
+from app import app
+from app import db
+from app.model import ChildBot
+from app.model import User
+
+USER_STATE_WRITE_BEHIND = environ.get('USER_STATE_WRITE_BEHIND') == '1'
+USER_STATE_FLUSH_INTERVAL = float(environ.get('USER_STATE_FLUSH_INTERVAL', 1))
+USER_STATE_FLUSH_THRESHOLD = int(
+    environ.get('USER_STATE_FLUSH_THRESHOLD', 500))
+USER_STATE_CACHE_SIZE = int(environ.get('USER_STATE_CACHE_SIZE', 100000))
+
+
+class UserState:
+    __slots__ = ('bot_id', 'tg_id', 'menu_path', '_store')
+
+    def __init__(self, store: 'UserStore', bot_id: int, tg_id: int,
+                 menu_path: Optional[str]):
+        self._store = store
+        self.bot_id = bot_id
+        self.tg_id = tg_id
+        self.menu_path = menu_path
+
+    def save(self):
+        self._store.save(self)
+
+
+class UserStore:
+    # Keeps menu_path of hot users in memory. Handlers get a copy of the
+    # state and call save() once their reply went out, so a failed send
+    # never leaks a half-made transition into the store.
+    #
+    # A save means a reply reached the user, so it also clears the blocked
+    # flag left by an earlier 403.
+    #
+    # In write-through mode every update reads the user once and every
+    # save goes to the database, which is safe with any number of
+    # workers. Write-behind mode only stays consistent while all updates
+    # of a chat reach one process.
+    def __init__(self, write_behind: bool, interval: float, threshold: int,
+                 size: int):
+        self.write_behind = write_behind
+        self.interval = interval
+        self.threshold = threshold
+        self.size = size
+        self.flushed = 0
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._new = set()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._pid = None
+
+    def load(self, bot_pointer: Union[int, str], user_id: int) -> UserState:
+        if isinstance(bot_pointer, str):
+            bot_pointer = ChildBot.get_by_token(bot_pointer).id
+
+        if not self.write_behind:
+            # Handlers of one update share the row through the app context
+            # instead of reading it again.
+            key = f'user_state_{bot_pointer}_{user_id}'
+            if has_app_context() and key in g:
+                menu_path = g.get(key)
+            else:
+                menu_path = User.get_user(bot_pointer, user_id).menu_path
+                if has_app_context():
+                    setattr(g, key, menu_path)
+            return UserState(self, bot_pointer, user_id, menu_path)
+
+        key = (bot_pointer, user_id)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return UserState(self, bot_pointer, user_id, self._cache[key])
+            if key in self._pending:
+                return UserState(self, bot_pointer, user_id,
+                                 self._pending[key])
+
+        row = db.session.query(User.menu_path).filter(
+            User.tg_id == user_id,
+            User.bot_id == bot_pointer,
+        ).first()
+
+        with self._lock:
+            if row is None:
+                self._new.add(key)
+                self._pending.setdefault(key, None)
+                menu_path = self._pending[key]
+            else:
+                menu_path = row.menu_path
+            self._remember(key, menu_path)
+
+        return UserState(self, bot_pointer, user_id, menu_path)
+
+    def save(self, state: UserState):
+        if not self.write_behind:
+            User.query.filter(
+                User.tg_id == state.tg_id,
+                User.bot_id == state.bot_id,
+            ).update({'menu_path': state.menu_path, 'blocked': False},
+                     synchronize_session=False)
+            db.session.commit()
+            if has_app_context():
+                setattr(g, f'user_state_{state.bot_id}_{state.tg_id}',
+                        state.menu_path)
+            return
+
+        self._start()
+        key = (state.bot_id, state.tg_id)
+        with self._lock:
+            self._remember(key, state.menu_path)
+            self._pending[key] = state.menu_path
+            pending = len(self._pending)
+
+        if pending >= self.threshold:
+            self.flush()
+
+    def _remember(self, key: Tuple[int, int], menu_path: Optional[str]):
+        self._cache[key] = menu_path
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.size:
+            # Dirty entries are still in _pending, so dropping them from
+            # the cache never loses a write.
+            self._cache.popitem(last=False)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                new, self._new = self._new, set()
+
+            if not pending:
+                return
+
+            inserts = [
+                {'bot_id': bot_id, 'tg_id': tg_id, 'menu_path': path}
+                for (bot_id, tg_id), path in pending.items()
+                if (bot_id, tg_id) in new
+            ]
+            updates = [
+                {'_bot_id': bot_id, '_tg_id': tg_id, '_menu_path': path}
+                for (bot_id, tg_id), path in pending.items()
+                if (bot_id, tg_id) not in new
+            ]
+
+            try:
+                with db.engine.begin() as connection:
+                    if inserts:
+                        statement = insert(User.__table__)
+                        connection.execute(statement.on_conflict_do_update(
+                            index_elements=['tg_id', 'bot_id'],
+                            set_={'menu_path': statement.excluded.menu_path,
+                                  'blocked': False},
+                        ), inserts)
+                    if updates:
+                        connection.execute(
+                            User.__table__.update().where(and_(
+                                User.bot_id == bindparam('_bot_id'),
+                                User.tg_id == bindparam('_tg_id'),
+                            )).values(menu_path=bindparam('_menu_path'),
+                                      blocked=False),
+                            updates,
+                        )
+            except Exception:
+                with self._lock:
+                    for key, path in pending.items():
+                        self._pending.setdefault(key, path)
+                    self._new |= new
+                raise
+
+            self.flushed += len(pending)
+
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def _start(self):
+        if self._pid == getpid():
+            return
+
+        with self._lock:
+            if self._pid == getpid():
+                return
+            Thread(target=self._run, daemon=True).start()
+            atexit.register(self._flush_at_exit)
+            self._pid = getpid()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception:
+                    traceback.print_exc()
+
+    def _flush_at_exit(self):
+        with app.app_context():
+            self.flush()
+
+
+users = UserStore(USER_STATE_WRITE_BEHIND, USER_STATE_FLUSH_INTERVAL,
+                  USER_STATE_FLUSH_THRESHOLD, USER_STATE_CACHE_SIZE)
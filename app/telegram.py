@@ -1,82 +1,297 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from json import dumps
+from json import loads
 from os import environ
 from re import search
-from threading import Lock
+from typing import Dict
+from typing import Optional
 from typing import Union
+from urllib.parse import urlencode
 
-from requests import post
+from flask import g
+from flask import has_app_context
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 from app import db
+from app.cache import LRUCache
+from app.cache import MISSING
+from app.client import current_client
 from app.model import Action
 from app.model import Button
-from app.model import ChildBot, Menu, User
+from app.model import ChildBot, Menu
+from app.model import bump_config_version
+from app.model import config_version
+from app.metrics import bot_label
+from app.metrics import keyboard_bytes_saved_total
+from app.metrics import ratelimit_wait_seconds
+from app.metrics import telegram_errors_total
+from app.metrics import telegram_retries_total
+from app.metrics import telegram_seconds
+from app.metrics import telegram_skipped_total
+from app.ratelimit import limiter
+from app.replica import on_primary
+from app.replica import read_query
+from app.resilience import TELEGRAM_RETRIES
+from app.resilience import breaker
+from app.resilience import is_blocked
+from app.resilience import mark_blocked
+from app.resilience import retry_delay
+from app.sharding import sharding
+from app.state import users
+from app.tracing import record_span
+from app.tracing import span
+
+KEYBOARD_CACHE_SIZE = int(environ.get('KEYBOARD_CACHE_SIZE', 10000))
+KEYBOARD_CACHE_TTL = float(environ.get('KEYBOARD_CACHE_TTL', 60))
+keyboards = LRUCache(KEYBOARD_CACHE_SIZE)
+
+# What a chat was last sent is known only to the process that sent it, so
+# this is only safe while one process receives all of a bot's updates: a
+# single gunicorn worker, serve_async or the poller. Per-chat lanes do not
+# help, they exist inside one worker and a chat's webhooks can reach any.
+KEYBOARD_SKIP_UNCHANGED = environ.get('KEYBOARD_SKIP_UNCHANGED') == '1'
+KEYBOARD_SENT_SIZE = int(environ.get('KEYBOARD_SENT_SIZE', 100000))
+KEYBOARD_SENT_TTL = float(environ.get('KEYBOARD_SENT_TTL', 3600))
+sent_keyboards = LRUCache(KEYBOARD_SENT_SIZE)
+
+WEBHOOK_ALLOWED_UPDATES = ['message']
+WEBHOOK_MAX_CONNECTIONS = int(environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_REGISTER_WORKERS = int(environ.get('WEBHOOK_REGISTER_WORKERS', 16))
+
+WEBHOOK_REPLY = environ.get('WEBHOOK_REPLY') == '1'
+INGRESS_MODE = environ.get('INGRESS_MODE', 'webhook')
+_WEBHOOK_REPLY_METHODS = ('sendMessage',)
+
+
+def begin_webhook_reply(bot_token: str):
+    g.webhook_reply_token = bot_token
+    g.webhook_reply = None
+
+
+def end_webhook_reply() -> Optional[dict]:
+    g.pop('webhook_reply_token', None)
+    held = g.pop('webhook_reply', None)
+    if held is None:
+        return None
+
+    command, data = held
+    reply = dict(data, method=command)
+    if 'reply_markup' in reply:
+        reply['reply_markup'] = loads(reply['reply_markup'])
+    return reply
+
+
+def _hold_webhook_reply(bot_token: str, command: str, data: dict) -> bool:
+    if command not in _WEBHOOK_REPLY_METHODS or not has_app_context():
+        return False
+    if g.get('webhook_reply_token') != bot_token:
+        return False
+
+    # Only the latest message is held back for the response body, the
+    # previous one is sent right away so the chat sees them in order.
+    previous = g.webhook_reply
+    g.webhook_reply = (command, data)
+    if previous is not None:
+        response = _call(bot_token, *previous)
+        if not response['ok'] and 'chat_id' in previous[1]:
+            # Its keyboard was recorded when it was held, but never shown.
+            forget_keyboard(bot_token, previous[1]['chat_id'])
+    return True
+
+
+def _call(bot_token: str, command: str, data: dict) -> dict:
+    bot = bot_label(bot_token)
+    for attempt in range(TELEGRAM_RETRIES + 1):
+        started = time.perf_counter()
+        with span('telegram', method=command):
+            response = current_client().call(bot_token, command, data)
+        telegram_seconds.observe(time.perf_counter() - started, bot, command)
+
+        delay = retry_delay(response)
+        if delay is None or attempt == TELEGRAM_RETRIES:
+            break
+        telegram_retries_total.inc(bot, command)
+        time.sleep(delay)
+
+    breaker.record(bot_token, response)
+    if not response['ok']:
+        telegram_errors_total.inc(bot, command, response.get('error_code'))
+        print(response)
+        if response.get('error_code') == 403 and data and 'chat_id' in data:
+            mark_blocked(bot_token, data['chat_id'])
+    return response
+
+
+def _keyboard_key(bot_token: str, chat_id: int) -> tuple:
+    return bot_token.split(':')[0], chat_id
+
+
+def _keyboard_digest(reply_markup: str) -> bytes:
+    return blake2b(reply_markup.encode(), digest_size=8).digest()
+
+
+def forget_keyboard(bot_token: str, chat_id: int):
+    sent_keyboards.pop(_keyboard_key(bot_token, chat_id))
+
+
+def _skip_unchanged_keyboard(bot_token: str, command: str,
+                             data: dict) -> (dict, Optional[bytes]):
+    # The chat keeps showing the last keyboard it got, so an identical
+    # one does not have to be sent again. Returns the data to send and
+    # the digest to remember once the message went through.
+    if not KEYBOARD_SKIP_UNCHANGED or command != 'sendMessage' or \
+            'reply_markup' not in data:
+        return data, None
+
+    digest = _keyboard_digest(data['reply_markup'])
+    key = _keyboard_key(bot_token, data['chat_id'])
+    if sent_keyboards.get(key) != digest:
+        return data, digest
 
+    keyboard_bytes_saved_total.inc(
+        bot_label(bot_token),
+        amount=len(urlencode({'reply_markup': data['reply_markup']})) + 1)
+    data = dict(data)
+    del data['reply_markup']
+    return data, None
 
-def _limit_calls_per_second(count: int):
-    lock = Lock()
-    min_interval = 1.0 / float(count)
 
-    def decorate(func):
-        last_time_called = time.perf_counter()
+def _remember_keyboard(bot_token: str, data: dict, digest: Optional[bytes]):
+    if digest is not None:
+        sent_keyboards.set(_keyboard_key(bot_token, data['chat_id']), digest,
+                           KEYBOARD_SENT_TTL)
 
-        def limited_func(*args, **kwargs):
-            lock.acquire()
-            nonlocal last_time_called
-            try:
-                elapsed = time.perf_counter() - last_time_called
-                left_to_wait = min_interval - elapsed
 
-                if left_to_wait > 0:
-                    time.sleep(left_to_wait)
-                return func(*args, **kwargs)
-            finally:
-                last_time_called = time.perf_counter()
-                lock.release()
-
-        return limited_func
-
-    return decorate
-
-
-@_limit_calls_per_second(30)
 def _send_message(bot_token: str,
                   command: str, data: dict = None) -> dict:
     if data is None:
         data = {}
-    response = post(
-        f'https://api.telegram.org/bot{bot_token}/{command}',
-        data,
-    )
-    data = response.json()
-    if not data['ok']:
-        print(data)
-    return data
 
+    # Calls that are certain to fail are not made and cost no rate limit.
+    chat_id = data.get('chat_id')
+    if chat_id is not None and is_blocked(bot_token, chat_id):
+        telegram_skipped_total.inc(bot_label(bot_token), 'blocked')
+        return {'ok': False, 'error_code': 403,
+                'description': 'Forbidden: the chat blocked the bot'}
+    if not breaker.allow(bot_token):
+        telegram_skipped_total.inc(bot_label(bot_token), 'circuit_open')
+        return {'ok': False, 'error_code': 401,
+                'description': 'Unauthorized: the token keeps failing'}
+
+    waited = limiter.acquire(bot_token, chat_id)
+    ratelimit_wait_seconds.observe(waited, bot_label(bot_token))
+    if waited:
+        record_span('ratelimit', waited, chat_id=chat_id)
+    data, digest = _skip_unchanged_keyboard(bot_token, command, data)
+    if _hold_webhook_reply(bot_token, command, data):
+        # Counted as delivered like the reply itself; should it be flushed
+        # by a later message and fail, the record is dropped again.
+        _remember_keyboard(bot_token, data, digest)
+        return {'ok': True, 'result': None}
+
+    response = _call(bot_token, command, data)
+    if response['ok']:
+        _remember_keyboard(bot_token, data, digest)
+    return response
 
-def set_up_webhook(bot_token: str):
-    project_name = environ['PROJECT_NAME']
-    hook_url = f'https://{project_name}.herokuapp.com/webhook/{bot_token}'
-    _send_message(bot_token, 'setWebhook', {'url': hook_url})
+
+def _webhook_is_current(info: dict, url: str) -> bool:
+    return info.get('url') == url and \
+        info.get('max_connections') == WEBHOOK_MAX_CONNECTIONS and \
+        sorted(info.get('allowed_updates', [])) == WEBHOOK_ALLOWED_UPDATES
+
+
+def set_up_webhook(bot_token: str, check: bool = False) -> str:
+    if INGRESS_MODE == 'polling':
+        # The poller removes webhooks itself, getUpdates refuses to work
+        # while one is set.
+        return 'skipped'
+
+    base_url = sharding.url(bot_token) or \
+        f'https://{environ["PROJECT_NAME"]}.herokuapp.com'
+    hook_url = f'{base_url}/webhook/{bot_token}'
+
+    if check:
+        response = _send_message(bot_token, 'getWebhookInfo')
+        if not response['ok']:
+            return 'failed'
+        if _webhook_is_current(response['result'], hook_url):
+            return 'skipped'
+
+    response = _send_message(bot_token, 'setWebhook', {
+        'url': hook_url,
+        'allowed_updates': dumps(WEBHOOK_ALLOWED_UPDATES),
+        'max_connections': WEBHOOK_MAX_CONNECTIONS,
+    })
+    return 'registered' if response['ok'] else 'failed'
 
 
 def check_bot_token(bot_token: str) -> bool:
-    response = _send_message(bot_token, 'getMe')
+    # The token is whatever somebody typed into the control bot, so it is
+    # not rate limited, tracked by the breaker or used as a metric label.
+    response = current_client().call(bot_token, 'getMe')
     return response['ok']
 
 
-def set_up_webhooks():
-    child_bots = ChildBot.query.all()
-    child_bots.append(environ['TELEGRAM_TOKEN'])
-    for child_bot in child_bots:
-        set_up_webhook(child_bot)
+def _register_webhook(bot_token: str) -> str:
+    try:
+        return set_up_webhook(bot_token, check=True)
+    except Exception as error:
+        print(f'Webhook of bot {bot_token.split(":")[0]} failed: {error}')
+        return 'failed'
+
+
+def set_up_webhooks() -> Dict[str, int]:
+    tokens = [environ['TELEGRAM_TOKEN']]
+    tokens.extend(token for token, in db.session.query(ChildBot.token))
+
+    results = {'registered': 0, 'skipped': 0, 'failed': 0}
+    with ThreadPoolExecutor(WEBHOOK_REGISTER_WORKERS) as executor:
+        outcomes = executor.map(_register_webhook, tokens)
+        for done, (token, outcome) in enumerate(zip(tokens, outcomes), 1):
+            results[outcome] += 1
+            if outcome == 'failed':
+                print(f'Webhook of bot {token.split(":")[0]} '
+                      f'was not registered')
+            if done % 100 == 0 or done == len(tokens):
+                print(f'Webhooks {done}/{len(tokens)}: {results}')
+
+    return results
+
+
+def _cached_keyboard(bot_id: int, key: tuple, build) -> (str, str):
+    # Entries of older configuration versions are never hit again and
+    # simply age out of the LRU. Other processes move on to the new version
+    # within CONFIG_VERSION_TTL, see config_version().
+    key = (bot_id, config_version(bot_id)) + key
+    value = keyboards.get(key)
+    if value is MISSING:
+        with on_primary():
+            value = build()
+        keyboards.set(key, value, KEYBOARD_CACHE_TTL)
+    return value
 
 
 def _get_reply_markup(bot_token: str, menu_path: str,
                       is_admin: bool = False) -> (str, str):
+    bot_id = ChildBot.get_by_token(bot_token).id
+    menu_name = menu_path.split('/')[-1]
+    is_root = menu_path == '_start_menu'
+
+    return _cached_keyboard(
+        bot_id, ('menu', menu_name, is_root, is_root and is_admin),
+        lambda: _build_reply_markup(bot_id, menu_path, is_admin),
+    )
+
+
+def _build_reply_markup(bot_id: int, menu_path: str,
+                        is_admin: bool) -> (str, str):
     menu_name = menu_path.split('/')[-1]
 
-    menu = Menu.get_menu(bot_token, menu_name)
+    menu = Menu.get_menu(bot_id, menu_name, with_buttons=True)
     if menu_name == '_start_menu':
         desc = 'Главное меню'
     else:
@@ -102,7 +317,7 @@ def _get_reply_markup(bot_token: str, menu_path: str,
 
 def send_start_message(bot_token: str, chat_id: int, user_id: int):
     bot = ChildBot.get_by_token(bot_token)
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     user.menu_path = '_start_menu'
 
     desc, reply = _get_reply_markup(bot_token, user.menu_path,
@@ -114,13 +329,11 @@ def send_start_message(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def send_previous_menu(bot_token: str, chat_id: int, user_id: int):
-    user = User.get_user(bot_token, user_id)
+    user = users.load(bot_token, user_id)
     if '/' not in user.menu_path:
         return
 
@@ -165,9 +378,7 @@ def send_previous_menu(bot_token: str, chat_id: int, user_id: int):
         })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def _get_settings_reply_markup() -> str:
@@ -182,18 +393,9 @@ def _get_settings_reply_markup() -> str:
 
 
 def button_click(bot_token: str, chat_id: int, user_id: int, text: str):
-    user = User.get_user(bot_token, user_id)
-    menu = Menu.query.filter(
-        Menu.bot_id == ChildBot.get_by_token(bot_token).id,
-        Menu.name == user.menu_path.split('/')[-1],
-    ).first()
-    if not menu:
-        return
-
-    button = Button.query.filter(
-        Button.menu_id == menu.id,
-        Button.text == text,
-    ).first()
+    bot = ChildBot.get_by_token(bot_token)
+    user = users.load(bot.id, user_id)
+    button = Button.find(bot.id, user.menu_path.split('/')[-1], text)
     if not button:
         return
 
@@ -201,8 +403,7 @@ def button_click(bot_token: str, chat_id: int, user_id: int, text: str):
         user.menu_path += f'/{button.action_name}'
         desc, repl = _get_reply_markup(bot_token,
                                        user.menu_path,
-                                       ChildBot.get_by_token(
-                                           bot_token).admin == user_id)
+                                       bot.admin == user_id)
         response = _send_message(bot_token, 'sendMessage', {
             'chat_id': chat_id,
             'text': desc,
@@ -210,15 +411,13 @@ def button_click(bot_token: str, chat_id: int, user_id: int, text: str):
         })
 
         if response['ok']:
-            db.session.commit()
-        else:
-            db.session.rollback()
+            user.save()
     elif button.action_type == 'a':
         start_action(bot_token, chat_id, button.action_name)
 
 
 def send_settings_menu(bot_token: str, chat_id: int, user_id: int):
-    user = User.get_user(bot_token, user_id)
+    user = users.load(bot_token, user_id)
     user.menu_path += '/_settings'
 
     response = _send_message(bot_token, 'sendMessage', {
@@ -228,14 +427,22 @@ def send_settings_menu(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def _get_menu_settings_reply_markup(bot_pointer: Union[int, str]) -> (str,
                                                                       str):
-    menus = Menu.get_menus(bot_pointer)
+    if isinstance(bot_pointer, str):
+        bot_pointer = ChildBot.get_by_token(bot_pointer).id
+
+    return _cached_keyboard(
+        bot_pointer, ('menus',),
+        lambda: _build_menu_settings_reply_markup(bot_pointer),
+    )
+
+
+def _build_menu_settings_reply_markup(bot_id: int) -> (str, str):
+    menus = Menu.get_menus(bot_id)
 
     keyboard = []
     for menu in menus:
@@ -255,7 +462,7 @@ def send_menu_settings(bot_token: str, chat_id: int, user_id: int):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if not user.menu_path == '_start_menu/_settings':
         return
 
@@ -269,9 +476,7 @@ def send_menu_settings(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def send_add_menu_menu(bot_token: str, chat_id: int, user_id: int):
@@ -279,7 +484,7 @@ def send_add_menu_menu(bot_token: str, chat_id: int, user_id: int):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if not user.menu_path == '_start_menu/_settings/_menus':
         return
 
@@ -299,9 +504,7 @@ def send_add_menu_menu(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def add_menu(bot_token: str, chat_id: int, user_id: int, text: str):
@@ -309,7 +512,7 @@ def add_menu(bot_token: str, chat_id: int, user_id: int, text: str):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if not user.menu_path == '_start_menu/_settings/_menus/_add_menu':
         return
 
@@ -361,14 +564,40 @@ def add_menu(bot_token: str, chat_id: int, user_id: int, text: str):
     menu.bot_id = bot.id
 
     db.session.add(menu)
-    db.session.commit()
+    bump_config_version(bot.id)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        _send_message(bot_token, 'sendMessage', {
+            'chat_id': chat_id,
+            'text': f'Меню {name} уже существует',
+            'reply_markup': dumps({
+                'resize_keyboard': True,
+                'keyboard': [
+                    [{'text': 'Назад'}],
+                ],
+            }),
+        })
+        return
 
     send_previous_menu(bot_token, chat_id, user_id)
 
 
 def _get_edit_menu_reply_markup(bot_pointer: Union[int, str],
                                 menu_name: str) -> (str, str):
-    menu = Menu.get_menu(bot_pointer, menu_name)
+    if isinstance(bot_pointer, str):
+        bot_pointer = ChildBot.get_by_token(bot_pointer).id
+
+    return _cached_keyboard(
+        bot_pointer, ('edit', menu_name),
+        lambda: _build_edit_menu_reply_markup(bot_pointer, menu_name),
+    )
+
+
+def _build_edit_menu_reply_markup(bot_id: int,
+                                  menu_name: str) -> (str, str):
+    menu = Menu.get_menu(bot_id, menu_name, with_buttons=True)
 
     keyboard = []
     for button in menu.buttons:
@@ -389,7 +618,7 @@ def send_edit_menu(bot_token: str, chat_id: int, user_id: int, text: str):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu/_settings/_menus':
         return
 
@@ -405,9 +634,7 @@ def send_edit_menu(bot_token: str, chat_id: int, user_id: int, text: str):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def send_add_button_menu(bot_token: str, chat_id: int, user_id: int):
@@ -415,7 +642,7 @@ def send_add_button_menu(bot_token: str, chat_id: int, user_id: int):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if not user.menu_path.startswith('_start_menu/_settings/_menus/'):
         return
 
@@ -453,9 +680,7 @@ def send_add_button_menu(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def add_button(bot_token: str, chat_id: int, user_id: int, text: str):
@@ -463,7 +688,7 @@ def add_button(bot_token: str, chat_id: int, user_id: int, text: str):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if not user.menu_path.startswith('_start_menu/_settings/_menus/'):
         return
 
@@ -557,6 +782,7 @@ def add_button(bot_token: str, chat_id: int, user_id: int, text: str):
 
     menu.buttons.append(button)
 
+    bump_config_version(bot.id)
     db.session.commit()
 
     _send_message(bot_token, 'sendMessage', {
@@ -574,6 +800,13 @@ def add_button(bot_token: str, chat_id: int, user_id: int, text: str):
 
 
 def _get_actions_settings_menu_reply_markup(bot_id: int) -> (str, str):
+    return _cached_keyboard(
+        bot_id, ('actions',),
+        lambda: _build_actions_settings_menu_reply_markup(bot_id),
+    )
+
+
+def _build_actions_settings_menu_reply_markup(bot_id: int) -> (str, str):
     keyboard = []
     buttons = db.session.query(Action.name).distinct().filter(
         Action.bot_id == bot_id).all()
@@ -598,7 +831,7 @@ def send_actions_settings_menu(bot_token: str, chat_id: int, user_id: int):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu/_settings':
         return
 
@@ -612,9 +845,7 @@ def send_actions_settings_menu(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def send_add_action(bot_token: str, chat_id: int, user_id: int):
@@ -622,7 +853,7 @@ def send_add_action(bot_token: str, chat_id: int, user_id: int):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu/_settings/_actions':
         return
 
@@ -642,9 +873,7 @@ def send_add_action(bot_token: str, chat_id: int, user_id: int):
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def add_new_action(bot_token: str, chat_id: int, user_id: int, text: str):
@@ -652,7 +881,7 @@ def add_new_action(bot_token: str, chat_id: int, user_id: int, text: str):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu/_settings/_actions/_add_action':
         return
 
@@ -709,10 +938,12 @@ def add_new_action(bot_token: str, chat_id: int, user_id: int, text: str):
     action.text = desc
 
     db.session.add(action)
+    bump_config_version(bot.id)
+    db.session.commit()
 
     user.menu_path = '/'.join(user.menu_path.split('/')[:-1])
+    user.save()
     send_edit_action_menu(bot_token, chat_id, user_id, name)
-    db.session.commit()
 
 
 def send_edit_action_menu(bot_token: str, chat_id: int,
@@ -721,7 +952,7 @@ def send_edit_action_menu(bot_token: str, chat_id: int,
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu/_settings/_actions':
         return
 
@@ -748,9 +979,7 @@ def send_edit_action_menu(bot_token: str, chat_id: int,
     })
 
     if response['ok']:
-        db.session.commit()
-    else:
-        db.session.rollback()
+        user.save()
 
 
 def add_subaction(bot_token: str, chat_id: int, user_id: int, text: str):
@@ -758,7 +987,7 @@ def add_subaction(bot_token: str, chat_id: int, user_id: int, text: str):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if not user.menu_path.startswith('_start_menu/_settings/_actions/'):
         return
 
@@ -769,8 +998,12 @@ def add_subaction(bot_token: str, chat_id: int, user_id: int, text: str):
     action = Action()
     action.name = user.menu_path.split('/')[-1]
     action.text = text
-    action.order = len(Action.query.filter(Action.bot_id == bot.id,
-                                           Action.name == action.name).all())
+    action.order = db.session.query(
+        func.coalesce(func.max(Action.order), -1) + 1,
+    ).filter(
+        Action.bot_id == bot.id,
+        Action.name == action.name,
+    ).scalar()
     action.bot_id = bot.id
 
     db.session.add(action)
@@ -793,7 +1026,7 @@ def delete_action(bot_token: str, chat_id: int, user_id: int, text: str):
     if bot.admin != user_id:
         return
 
-    user = User.get_user(bot.id, user_id)
+    user = users.load(bot.id, user_id)
     if user.menu_path != '_start_menu/_settings/_actions':
         return
 
@@ -817,12 +1050,12 @@ def delete_action(bot_token: str, chat_id: int, user_id: int, text: str):
     for action in actions:
         db.session.remove(action)
 
+    bump_config_version(bot.id)
     db.session.commit()
 
 
 def start_action(bot_token: str, chat_id: int, action_name: str):
-    print(Action.query.all())
-    actions = Action.query.filter(
+    actions = read_query(Action).filter(
         Action.bot_id == ChildBot.get_by_token(bot_token).id,
         Action.name == action_name,
     ).order_by(Action.order).all()
@@ -834,8 +1067,8 @@ def start_action(bot_token: str, chat_id: int, action_name: str):
         })
 
 
-def send_message(bot_token: str, chat_id: int, text: str):
-    _send_message(bot_token, 'sendMessage', {
+def send_message(bot_token: str, chat_id: int, text: str) -> dict:
+    return _send_message(bot_token, 'sendMessage', {
         'chat_id': chat_id,
         'text': text,
     })
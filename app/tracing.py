@@ -0,0 +1,131 @@
+import cProfile
+import hmac
+import io
+import json
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from os import environ
+from os import listdir
+from os import makedirs
+from os import path
+from os import remove
+from os import replace
+from threading import local
+from typing import List
+from typing import Optional
+
+TRACE_SAMPLE_RATE = float(environ.get('TRACE_SAMPLE_RATE', 0))
+TRACE_KEY = environ.get('TRACE_KEY')
+TRACE_HEADER = 'X-Debug-Trace'
+TRACE_DIR = environ.get('TRACE_DIR', '/tmp/traces')
+TRACE_KEEP = int(environ.get('TRACE_KEEP', 200))
+TRACE_PROFILE = environ.get('TRACE_PROFILE') == '1'
+
+_local = local()
+
+
+class Trace:
+    def __init__(self, name: str, profile: bool):
+        self.name = name
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.profiler = cProfile.Profile() if profile else None
+
+    def add(self, name: str, started: float, duration: float, **detail):
+        self.spans.append(dict(
+            detail,
+            name=name,
+            start=started - self.started,
+            duration=duration,
+        ))
+
+
+def is_trace_key(value: Optional[str]) -> bool:
+    return bool(TRACE_KEY) and value is not None and \
+        hmac.compare_digest(value.encode(), TRACE_KEY.encode())
+
+
+def should_trace(header: Optional[str]) -> bool:
+    if is_trace_key(header):
+        return True
+    return random.random() < TRACE_SAMPLE_RATE
+
+
+def record_span(name: str, duration: float, **detail):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add(name, time.perf_counter() - duration, duration, **detail)
+
+
+@contextmanager
+def span(name: str, **detail):
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started, **detail)
+
+
+@contextmanager
+def tracing(name: str, enabled: bool):
+    if not enabled or getattr(_local, 'trace', None) is not None:
+        yield
+        return
+
+    trace = _local.trace = Trace(name, TRACE_PROFILE)
+    if trace.profiler is not None:
+        trace.profiler.enable()
+    try:
+        yield
+    finally:
+        if trace.profiler is not None:
+            trace.profiler.disable()
+        _local.trace = None
+        try:
+            _save(trace)
+        except OSError as error:
+            print(f'Trace {name} was not saved: {error}')
+
+
+def _save(trace: Trace):
+    document = {
+        'name': trace.name,
+        'started': trace.wall,
+        'duration': time.perf_counter() - trace.started,
+        'spans': trace.spans,
+    }
+    if trace.profiler is not None:
+        output = io.StringIO()
+        pstats.Stats(trace.profiler, stream=output).sort_stats(
+            'cumulative').print_stats(50)
+        document['profile'] = output.getvalue()
+
+    makedirs(TRACE_DIR, exist_ok=True)
+    file_name = f'{time.time_ns()}-{trace.name}.json'
+    temporary = path.join(TRACE_DIR, f'.{file_name}')
+    with open(temporary, 'w') as file:
+        json.dump(document, file)
+    replace(temporary, path.join(TRACE_DIR, file_name))
+
+    # The directory is a ring buffer of the newest TRACE_KEEP traces.
+    for old in list_traces()[TRACE_KEEP:]:
+        try:
+            remove(path.join(TRACE_DIR, old))
+        except OSError:
+            pass
+
+
+def list_traces() -> List[str]:
+    if not path.isdir(TRACE_DIR):
+        return []
+    return sorted((name for name in listdir(TRACE_DIR)
+                   if name.endswith('.json') and not name.startswith('.')),
+                  reverse=True)
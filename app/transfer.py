@@ -0,0 +1,150 @@
+from itertools import groupby
+from os import environ
+from re import fullmatch
+from typing import List
+from typing import Tuple
+
+from app import db
+from app.model import Action
+from app.model import Button
+from app.model import Menu
+from app.model import bump_config_version
+from app.replica import read_query
+
+# Menus can be read and replaced wholesale through /bots/<token>/config, so
+# the endpoints answer only to requests carrying this key and not at all
+# without one.
+CONFIG_KEY = environ.get('CONFIG_KEY')
+CONFIG_KEY_HEADER = 'X-Config-Key'
+
+
+def export_bot(bot_id: int) -> dict:
+    menus = read_query(Menu).options(db.joinedload(Menu.buttons)).filter(
+        Menu.bot_id == bot_id).order_by(Menu.id).all()
+    actions = read_query(Action).filter(Action.bot_id == bot_id).order_by(
+        Action.name, Action.order).all()
+
+    return {
+        'menus': [{
+            'name': menu.name,
+            'description': menu.description,
+            'buttons': [{
+                'text': button.text,
+                'action_type': button.action_type,
+                'action_name': button.action_name,
+            } for button in sorted(menu.buttons, key=lambda b: b.id)],
+        } for menu in menus],
+        'actions': [{
+            'name': name,
+            'messages': [action.text for action in lines],
+        } for name, lines in groupby(actions, key=lambda a: a.name)],
+    }
+
+
+def _validate(document: dict) -> Tuple[List[dict], List[dict]]:
+    if not isinstance(document, dict):
+        raise ValueError('document must be an object')
+
+    menus = document.get('menus', [])
+    actions = document.get('actions', [])
+    if not isinstance(menus, list) or not isinstance(actions, list):
+        raise ValueError('menus and actions must be lists')
+
+    action_names = set()
+    for action in actions:
+        if not isinstance(action, dict):
+            raise ValueError('actions must be objects')
+        name = action.get('name')
+        if not isinstance(name, str) or not fullmatch(r'[a-zA-Z]+', name):
+            raise ValueError(f'invalid action name {name!r}')
+        if name in action_names:
+            raise ValueError(f'action {name} is defined twice')
+        messages = action.get('messages')
+        if not messages or not isinstance(messages, list) or \
+                not all(isinstance(m, str) and m.strip() for m in messages):
+            raise ValueError(f'action {name} needs non-empty messages')
+        action_names.add(name)
+
+    menu_names = set()
+    for menu in menus:
+        if not isinstance(menu, dict):
+            raise ValueError('menus must be objects')
+        name = menu.get('name')
+        if not isinstance(name, str) or \
+                not fullmatch(r'_start_menu|[a-zA-Z]+', name):
+            raise ValueError(f'invalid menu name {name!r}')
+        if name in menu_names:
+            raise ValueError(f'menu {name} is defined twice')
+        if not isinstance(menu.get('description', ''), str):
+            raise ValueError(f'menu {name} has an invalid description')
+        if not isinstance(menu.get('buttons', []), list):
+            raise ValueError(f'buttons of menu {name} must be a list')
+        menu_names.add(name)
+
+    for menu in menus:
+        for button in menu.get('buttons', []):
+            if not isinstance(button, dict):
+                raise ValueError(f'buttons of menu {menu["name"]} must be '
+                                 f'objects')
+            if not isinstance(button.get('text'), str) or \
+                    not button['text']:
+                raise ValueError(f'empty button text in menu {menu["name"]}')
+            targets = {'m': menu_names, 'a': action_names}.get(
+                button.get('action_type'))
+            if targets is None:
+                raise ValueError(f'button {button["text"]} needs action type '
+                                 f'"a" or "m"')
+            if button.get('action_name') not in targets:
+                raise ValueError(f'button {button["text"]} points to unknown '
+                                 f'{button.get("action_name")!r}')
+
+    return menus, actions
+
+
+def import_bot(bot_id: int, document: dict):
+    menus, actions = _validate(document)
+
+    # The whole configuration is replaced with a handful of set based
+    # statements in one transaction instead of a commit per row.
+    try:
+        db.session.query(Button).filter(Button.menu_id.in_(
+            db.session.query(Menu.id).filter(Menu.bot_id == bot_id)
+        )).delete(synchronize_session=False)
+        Menu.query.filter(Menu.bot_id == bot_id).delete(
+            synchronize_session=False)
+        Action.query.filter(Action.bot_id == bot_id).delete(
+            synchronize_session=False)
+
+        if menus:
+            db.session.execute(Menu.__table__.insert(), [{
+                'bot_id': bot_id,
+                'name': menu['name'],
+                'description': menu.get('description', ''),
+            } for menu in menus])
+
+        menu_ids = dict(db.session.query(Menu.name, Menu.id).filter(
+            Menu.bot_id == bot_id))
+        buttons = [{
+            'menu_id': menu_ids[menu['name']],
+            'text': button['text'],
+            'action_type': button['action_type'],
+            'action_name': button['action_name'],
+        } for menu in menus for button in menu.get('buttons', [])]
+        if buttons:
+            db.session.execute(Button.__table__.insert(), buttons)
+
+        lines = [{
+            'bot_id': bot_id,
+            'name': action['name'],
+            'order': order,
+            'text': text.strip(),
+        } for action in actions
+            for order, text in enumerate(action['messages'])]
+        if lines:
+            db.session.execute(Action.__table__.insert(), lines)
+
+        bump_config_version(bot_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
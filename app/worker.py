@@ -0,0 +1,118 @@
+import traceback
+from multiprocessing import Process
+from multiprocessing import Queue as ProcessQueue
+from os import environ
+from os import getpid
+from queue import Full
+from queue import Queue
+from threading import Lock
+from threading import Thread
+from typing import Callable
+from typing import List
+
+from app import app
+from app import db
+from app.client import TELEGRAM_API_URL
+from app.client import TELEGRAM_POOL_SIZE
+from app.client import TELEGRAM_TIMEOUT
+from app.client import TelegramClient
+from app.client import use_client
+
+UPDATE_WORKERS = int(environ.get('UPDATE_WORKERS', 0))
+UPDATE_WORKER_KIND = environ.get('UPDATE_WORKER_KIND', 'thread')
+UPDATE_QUEUE_SIZE = int(environ.get('UPDATE_QUEUE_SIZE', 1000))
+
+
+def _run(handler: Callable, queue, in_process: bool):
+    if in_process:
+        # Connections inherited from the parent must not be shared.
+        with app.app_context():
+            db.engine.dispose()
+        # Neither are the parent's Bot API connections. Under serve_async
+        # the inherited client hands its calls to the parent's event loop,
+        # which does not run here, so the lane gets a client of its own.
+        use_client(TelegramClient(TELEGRAM_API_URL, TELEGRAM_POOL_SIZE,
+                                  TELEGRAM_TIMEOUT))
+
+    while True:
+        bot_token, update, trace = queue.get()
+        with app.app_context():
+            try:
+                handler(bot_token, update, trace)
+            except Exception:
+                traceback.print_exc()
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+class UpdatePool:
+    def __init__(self, handler: Callable, workers: int, kind: str,
+                 size: int):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f'Unknown worker kind {kind}')
+
+        self.handler = handler
+        self.workers = workers
+        self.kind = kind
+        self.size = size
+        self._lanes = []
+        self._pid = None
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _start(self):
+        # Workers are started lazily so that every gunicorn worker gets
+        # its own pool after the fork instead of inheriting dead threads.
+        with self._lock:
+            if self._pid == getpid():
+                return
+
+            # One lane per worker, each lane is drained in order by its
+            # own worker.
+            lane_size = max(1, self.size // self.workers)
+            if self.kind == 'process':
+                self._lanes = [ProcessQueue(lane_size)
+                               for _ in range(self.workers)]
+                for lane in self._lanes:
+                    Process(target=_run,
+                            args=(self.handler, lane, True),
+                            daemon=True).start()
+            else:
+                self._lanes = [Queue(lane_size) for _ in range(self.workers)]
+                for lane in self._lanes:
+                    Thread(target=_run,
+                           args=(self.handler, lane, False),
+                           daemon=True).start()
+
+            self._pid = getpid()
+
+    def _lane(self, bot_token: str, update: dict):
+        # Updates of one chat always land in the same lane, so they run one
+        # after another while other chats run in parallel.
+        bot_key = int(bot_token.split(':')[0])
+        chat_id = update['message']['chat']['id']
+        return self._lanes[hash((bot_key, chat_id)) % len(self._lanes)]
+
+    def submit(self, bot_token: str, update: dict,
+               trace: bool = False) -> bool:
+        if self._pid != getpid():
+            self._start()
+
+        try:
+            self._lane(bot_token, update).put_nowait(
+                (bot_token, update, trace))
+        except Full:
+            return False
+        return True
+
+    def depth(self) -> int:
+        return sum(self.lane_depths())
+
+    def lane_depths(self) -> List[int]:
+        if self._pid != getpid():
+            return []
+        return [lane.qsize() for lane in self._lanes]
@@ -0,0 +1,136 @@
+import argparse
+import json
+import random
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qs
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    # Answers Bot API calls the way api.telegram.org does, with a
+    # configurable latency, error rate and share of 429 answers.
+    protocol_version = 'HTTP/1.1'
+
+    latency = 0.05
+    jitter = 0.01
+    error_rate = 0.0
+    flood_rate = 0.0
+    retry_after = 1
+
+    calls = Counter()
+    lock = Lock()
+    message_id = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.lock:
+                self._answer(200, dict(self.calls))
+        else:
+            self._answer(404, {'ok': False})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(body or '{}')
+        else:
+            data = {key: values[0] for key, values in parse_qs(body).items()}
+
+        try:
+            _, method = self.path.rsplit('/', 1)
+        except ValueError:
+            method = ''
+
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+        roll = random.random()
+        with self.lock:
+            self.calls[method] += 1
+            if roll < self.flood_rate:
+                self.calls['429'] += 1
+            elif roll < self.flood_rate + self.error_rate:
+                self.calls['error'] += 1
+
+        if roll < self.flood_rate:
+            self._answer(429, {
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after '
+                               f'{self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            })
+        elif roll < self.flood_rate + self.error_rate:
+            self._answer(400, {
+                'ok': False,
+                'error_code': 400,
+                'description': 'Bad Request: fake error',
+            })
+        else:
+            self._answer(200, {'ok': True, 'result': self._result(method,
+                                                                  data)})
+
+    def _result(self, method: str, data: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake'}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'pending_update_count': 0}
+        if method == 'getUpdates':
+            return []
+        if method == 'sendMessage':
+            with self.lock:
+                FakeBotApi.message_id += 1
+                message_id = FakeBotApi.message_id
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0))},
+                'text': data.get('text', ''),
+            }
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Telegram Bot API. Point the app '
+                    'at it with TELEGRAM_API_URL=http://host:port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=50,
+                        help='mean answer latency in ms')
+    parser.add_argument('--jitter', type=float, default=10,
+                        help='latency standard deviation in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of calls answered with a 400')
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help='share of calls answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    FakeBotApi.latency = args.latency / 1000
+    FakeBotApi.jitter = args.jitter / 1000
+    FakeBotApi.error_rate = args.error_rate
+    FakeBotApi.flood_rate = args.flood_rate
+    FakeBotApi.retry_after = args.retry_after
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeBotApi)
+    server.daemon_threads = True
+    print(f'Fake Bot API on http://{args.host}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
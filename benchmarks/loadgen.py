@@ -0,0 +1,240 @@
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+from itertools import count
+from os import environ
+from threading import Lock
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+BOT_ID_OFFSET = 900000000
+USER_ID_OFFSET = 100000000
+
+CONFIG = {
+    'menus': [
+        {'name': '_start_menu', 'description': '', 'buttons': [
+            {'text': 'Каталог', 'action_type': 'm', 'action_name': 'catalog'},
+            {'text': 'О нас', 'action_type': 'a', 'action_name': 'about'},
+        ]},
+        {'name': 'catalog', 'description': 'Каталог', 'buttons': [
+            {'text': f'Товар {n}', 'action_type': 'a', 'action_name': 'about'}
+            for n in range(10)
+        ]},
+    ],
+    'actions': [
+        {'name': 'about', 'messages': ['Мы бот', 'Пишите нам']},
+    ],
+}
+
+USER_SCRIPT = ['/start', 'Каталог', 'Товар 3', 'Назад', 'О нас']
+ADMIN_SCRIPT = ['/start', 'Настройки', 'Настройки меню', 'Назад',
+                'Настройки действий', 'Назад', 'Назад']
+
+
+def bot_token(bot: int) -> str:
+    return f'{BOT_ID_OFFSET + bot}:loadtest{bot:06d}'
+
+
+def user_id(bot: int, user: int, users: int) -> int:
+    return USER_ID_OFFSET + bot * users + user
+
+
+def seed(database_url: str, app_url: str, bots: int, users: int,
+         config_key: str):
+    engine = create_engine(database_url)
+    with engine.begin() as connection:
+        for bot in range(bots):
+            connection.execute(text(
+                'INSERT INTO child_bots (admin, token) '
+                'VALUES (:admin, :token) ON CONFLICT (token) DO NOTHING'
+            ), {'admin': user_id(bot, 0, users), 'token': bot_token(bot)})
+
+    session = Session()
+    for bot in range(bots):
+        session.put(f'{app_url}/bots/{bot_token(bot)}/config',
+                    json=CONFIG,
+                    headers={'X-Config-Key': config_key}).raise_for_status()
+
+
+def scrape(session: Session, app_url: str) -> dict:
+    try:
+        body = session.get(f'{app_url}/metrics', timeout=10).text
+    except Exception:
+        return {}
+
+    totals = {}
+    for name in ('update_db_queries_sum', 'update_db_queries_count'):
+        totals[name] = sum(
+            float(value) for value in
+            re.findall(rf'^{name}(?:{{[^}}]*}})? (\S+)$', body, re.M))
+    return totals
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def run(args) -> dict:
+    session = Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=args.concurrency))
+    session.mount('https://', HTTPAdapter(pool_maxsize=args.concurrency))
+    # The app drops update ids it has already seen, so every run starts
+    # somewhere else. Update ids fit in 31 bits, the offset leaves room for
+    # 2 ** 30 updates per run.
+    update_ids = count(random.randrange(2 ** 30))
+    latencies = []
+    errors = 0
+    lock = Lock()
+
+    def send(bot: int, user: int, message: str):
+        nonlocal errors
+        tg_id = user_id(bot, user, args.users)
+        update_id = next(update_ids)
+        update = {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': {'id': tg_id, 'is_bot': False, 'first_name': 'Load'},
+                'chat': {'id': tg_id, 'type': 'private'},
+                'date': int(time.time()),
+                'text': message,
+            },
+        }
+
+        started = time.perf_counter()
+        try:
+            response = session.post(
+                f'{args.app_url}/webhook/{bot_token(bot)}', json=update,
+                timeout=60)
+            ok = response.status_code == 200
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    def play(bot: int, user: int):
+        # One user's updates are sent in order, like a real chat.
+        script = ADMIN_SCRIPT if user == 0 else USER_SCRIPT
+        for _ in range(args.rounds):
+            for message in script:
+                send(bot, user, message)
+
+    sessions = [(bot, user) for bot in range(args.bots)
+                for user in range(args.users)]
+    random.shuffle(sessions)
+
+    # /metrics is kept per process, so with several workers the two
+    # scrapes may come from different ones and their difference means
+    # nothing. Queries per update are only measured against a server
+    # started with a single worker.
+    before = scrape(session, args.app_url) if args.single_worker else {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for future in [executor.submit(play, *s) for s in sessions]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    after = scrape(session, args.app_url) if args.single_worker else {}
+
+    updates = after.get('update_db_queries_count', 0) - \
+        before.get('update_db_queries_count', 0)
+    queries = after.get('update_db_queries_sum', 0) - \
+        before.get('update_db_queries_sum', 0)
+
+    return {
+        'date': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            'bots': args.bots,
+            'users': args.users,
+            'rounds': args.rounds,
+            'concurrency': args.concurrency,
+        },
+        'updates': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'updates_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'db_queries_per_update': queries / updates if updates else None,
+        'db_queries_scope': 'single worker' if args.single_worker else
+                            'not measured, needs --single-worker',
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    regressed = False
+    checks = (('updates_per_second', False), ('p50_ms', True),
+              ('p99_ms', True), ('db_queries_per_update', True))
+    for key, lower_is_better in checks:
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if lower_is_better else \
+            change < -tolerance
+        regressed |= worse
+        print(f'{key}: {old:.2f} -> {new:.2f} ({change:+.1%})'
+              f'{"  REGRESSION" if worse else ""}')
+    return not regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay synthetic Telegram updates against '
+                    '/webhook/<token> and report throughput and latency.')
+    parser.add_argument('--app-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--bots', type=int, default=10)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seed', action='store_true',
+                        help='create the bots and their menus first, needs '
+                             'DATABASE_URL')
+    parser.add_argument('--config-key', default=environ.get('CONFIG_KEY'),
+                        help="the app's CONFIG_KEY, needed by --seed")
+    parser.add_argument('--single-worker', action='store_true',
+                        help='the app runs in a single process, e.g. '
+                             'gunicorn -w 1 or serve_async without '
+                             'UPDATE_WORKER_KIND=process, so /metrics '
+                             'covers every update and queries per update '
+                             'can be reported')
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='compare with an earlier result')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(environ['DATABASE_URL'], args.app_url, args.bots, args.users,
+             args.config_key)
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if not compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
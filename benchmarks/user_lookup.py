@@ -0,0 +1,72 @@
+import argparse
+import random
+import time
+from os import environ
+
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+LOOKUP = text('SELECT id, menu_path FROM bench_users '
+              'WHERE tg_id = :tg_id AND bot_id = :bot_id')
+
+
+def measure(connection, users: int, bots: int, lookups: int) -> float:
+    started = time.perf_counter()
+    for _ in range(lookups):
+        connection.execute(LOOKUP, {
+            'tg_id': random.randrange(users // bots),
+            'bot_id': random.randrange(bots),
+        }).first()
+    return (time.perf_counter() - started) / lookups
+
+
+def plan(connection) -> str:
+    rows = connection.execute(text(
+        'EXPLAIN ANALYZE SELECT id, menu_path FROM bench_users '
+        'WHERE tg_id = 42 AND bot_id = 7'))
+    return '\n'.join(row[0] for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare users lookups with and without the '
+                    '(tg_id, bot_id) index.')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    engine = create_engine(environ['DATABASE_URL'])
+    with engine.connect() as connection:
+        connection.execute(text('''
+            CREATE TEMPORARY TABLE bench_users (
+                id serial PRIMARY KEY,
+                tg_id integer,
+                bot_id integer,
+                menu_path varchar
+            )
+        '''))
+        connection.execute(text('''
+            INSERT INTO bench_users (tg_id, bot_id, menu_path)
+            SELECT n / :bots, n % :bots, '_start_menu'
+            FROM generate_series(0, :users - 1) AS n
+        '''), {'users': args.users, 'bots': args.bots})
+        connection.execute(text('ANALYZE bench_users'))
+
+        seq_scan = measure(connection, args.users, args.bots, args.lookups)
+        print(plan(connection))
+        print(f'without index: {seq_scan * 1000:.3f} ms per lookup')
+
+        connection.execute(text(
+            'CREATE UNIQUE INDEX ON bench_users (tg_id, bot_id)'))
+        connection.execute(text('ANALYZE bench_users'))
+
+        index_scan = measure(connection, args.users, args.bots,
+                             args.lookups)
+        print(plan(connection))
+        print(f'with index: {index_scan * 1000:.3f} ms per lookup')
+        print(f'speedup: {seq_scan / index_scan:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""add lookup indexes and unique constraints
+
+Revision ID: 3f1c2a9d7b10
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The tables were created by db.create_all(), which already creates
+    # these indexes on fresh databases, hence IF NOT EXISTS everywhere.
+    # Duplicates that the old get-or-create races produced are merged
+    # first so the unique indexes can be built.
+    op.execute('''
+        DELETE FROM users a
+        USING users b
+        WHERE a.tg_id = b.tg_id
+          AND a.bot_id = b.bot_id
+          AND a.id > b.id
+    ''')
+    op.execute('''
+        UPDATE buttons
+        SET menu_id = m.keep_id
+        FROM (
+            SELECT id, min(id) OVER (PARTITION BY bot_id, name) AS keep_id
+            FROM menus
+        ) m
+        WHERE buttons.menu_id = m.id
+          AND m.id <> m.keep_id
+    ''')
+    op.execute('''
+        DELETE FROM menus a
+        USING menus b
+        WHERE a.bot_id = b.bot_id
+          AND a.name = b.name
+          AND a.id > b.id
+    ''')
+    op.execute('''
+        UPDATE actions
+        SET "order" = r.position
+        FROM (
+            SELECT id, row_number() OVER (
+                PARTITION BY bot_id, name ORDER BY "order", id
+            ) - 1 AS position
+            FROM actions
+        ) r
+        WHERE actions.id = r.id
+          AND actions."order" IS DISTINCT FROM r.position
+    ''')
+
+    op.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_users_tg_id_bot_id '
+               'ON users (tg_id, bot_id)')
+    op.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_menus_bot_id_name '
+               'ON menus (bot_id, name)')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_buttons_menu_id_text '
+               'ON buttons (menu_id, text)')
+    op.execute('CREATE UNIQUE INDEX IF NOT EXISTS '
+               'ix_actions_bot_id_name_order '
+               'ON actions (bot_id, name, "order")')
+
+
+def downgrade():
+    op.drop_index('ix_actions_bot_id_name_order', table_name='actions')
+    op.drop_index('ix_buttons_menu_id_text', table_name='buttons')
+    op.drop_index('ix_menus_bot_id_name', table_name='menus')
+    op.drop_index('ix_users_tg_id_bot_id', table_name='users')
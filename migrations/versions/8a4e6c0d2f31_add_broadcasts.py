@@ -0,0 +1,35 @@
+"""add broadcasts
+
+Revision ID: 8a4e6c0d2f31
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6c0d2f31'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() may have created the table already.
+    op.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            bot_id INTEGER REFERENCES child_bots (id),
+            text VARCHAR,
+            last_user_id INTEGER,
+            sent INTEGER,
+            failed INTEGER,
+            finished BOOLEAN
+        )
+    ''')
+
+
+def downgrade():
+    op.drop_table('broadcasts')
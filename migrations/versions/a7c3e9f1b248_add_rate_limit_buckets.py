@@ -0,0 +1,33 @@
+"""add rate limit buckets
+
+Revision ID: a7c3e9f1b248
+Revises: f4a9b2d6c817
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f1b248'
+down_revision = 'f4a9b2d6c817'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() may have created the table already.
+    op.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key VARCHAR PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated DOUBLE PRECISION NOT NULL
+        )
+    ''')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_rate_limit_buckets_updated '
+               'ON rate_limit_buckets (updated)')
+
+
+def downgrade():
+    op.drop_table('rate_limit_buckets')
@@ -0,0 +1,26 @@
+"""add child_bots.config_version
+
+Revision ID: b6d8f0a2c495
+Revises: a7c3e9f1b248
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d8f0a2c495'
+down_revision = 'a7c3e9f1b248'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('ALTER TABLE child_bots '
+               'ADD COLUMN IF NOT EXISTS config_version INTEGER NOT NULL '
+               'DEFAULT 0')
+
+
+def downgrade():
+    op.drop_column('child_bots', 'config_version')
@@ -0,0 +1,30 @@
+"""add polling offsets
+
+Revision ID: c5d2e7f4a913
+Revises: 8a4e6c0d2f31
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d2e7f4a913'
+down_revision = '8a4e6c0d2f31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() may have created the table already.
+    op.execute('''
+        CREATE TABLE IF NOT EXISTS polling_offsets (
+            bot_key BIGINT PRIMARY KEY,
+            next_update_id BIGINT NOT NULL
+        )
+    ''')
+
+
+def downgrade():
+    op.drop_table('polling_offsets')
@@ -0,0 +1,34 @@
+"""add processed updates
+
+Revision ID: e1b7a3c9d520
+Revises: c5d2e7f4a913
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b7a3c9d520'
+down_revision = 'c5d2e7f4a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() may have created the table already.
+    op.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            bot_key BIGINT,
+            update_id BIGINT,
+            seen_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now(),
+            PRIMARY KEY (bot_key, update_id)
+        )
+    ''')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_processed_updates_seen_at '
+               'ON processed_updates (seen_at)')
+
+
+def downgrade():
+    op.drop_table('processed_updates')
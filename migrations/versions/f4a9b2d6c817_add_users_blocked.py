@@ -0,0 +1,26 @@
+"""add users.blocked
+
+Revision ID: f4a9b2d6c817
+Revises: e1b7a3c9d520
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a9b2d6c817'
+down_revision = 'e1b7a3c9d520'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('ALTER TABLE users '
+               'ADD COLUMN IF NOT EXISTS blocked BOOLEAN NOT NULL '
+               'DEFAULT false')
+
+
+def downgrade():
+    op.drop_column('users', 'blocked')
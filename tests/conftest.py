@@ -0,0 +1,24 @@
+import os
+
+# The app reads its configuration at import time.
+os.environ.setdefault('TELEGRAM_TOKEN', '1:control')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import pytest
+
+from app import app as flask_app
+from app import db
+
+
+@pytest.fixture
+def app_context():
+    with flask_app.app_context():
+        yield
+
+
+@pytest.fixture
+def database(app_context):
+    db.create_all()
+    yield
+    db.session.remove()
+    db.drop_all()
@@ -0,0 +1,25 @@
+import pytest
+
+from app.dedup import UpdateDeduplicator
+
+
+def test_redelivery_is_dropped():
+    dedup = UpdateDeduplicator(60, 100, shared=False)
+
+    assert dedup.first_seen(1, 10, '1')
+    assert not dedup.first_seen(1, 10, '1')
+    assert dedup.first_seen(2, 10, '2')
+
+
+def test_failed_claim_lets_the_retry_through(monkeypatch):
+    dedup = UpdateDeduplicator(60, 100, shared=True)
+
+    def fail(bot_id, update_id):
+        raise RuntimeError('database is down')
+
+    monkeypatch.setattr(dedup, '_claim', fail)
+    with pytest.raises(RuntimeError):
+        dedup.first_seen(1, 10, '1')
+
+    monkeypatch.setattr(dedup, '_claim', lambda bot_id, update_id: True)
+    assert dedup.first_seen(1, 10, '1')
@@ -0,0 +1,155 @@
+from re import compile
+
+from sqlalchemy import text
+
+from app import app
+from app import db
+from app import routes
+from app.client import current_client
+from app.client import use_client
+from app.dispatcher import Dispatcher
+from app.dispatcher import Update
+from app.metrics import query_budget_exceeded_total
+from app.model import Button
+from app.model import ChildBot
+from app.model import Menu
+from app.model import User
+from app.queries import count_queries
+from app.state import users
+
+
+def make_update(text: str, path: str = '') -> Update:
+    return Update('1:test', 1, 1, text, None,
+                  tuple(path.split('/')) if path else ())
+
+
+def test_resolve_prefers_exact_text_then_pattern_then_any():
+    dispatcher = Dispatcher()
+
+    @dispatcher.route(state='_start_menu', text='Настройки')
+    def exact(update):
+        pass
+
+    @dispatcher.route(state='_start_menu', text=compile(r'Меню \d+'))
+    def pattern(update):
+        pass
+
+    @dispatcher.route(state='_start_menu')
+    def any_text(update):
+        pass
+
+    assert dispatcher.resolve(make_update('Настройки', '_start_menu')) \
+        is exact
+    assert dispatcher.resolve(make_update('Меню 2', '_start_menu')) \
+        is pattern
+    assert dispatcher.resolve(make_update('other', '_start_menu')) \
+        is any_text
+    assert dispatcher.resolve(make_update('other', '_other')) is None
+
+
+def test_resolve_wildcards_and_stateless_routes():
+    dispatcher = Dispatcher()
+
+    @dispatcher.route(text='/start')
+    def start(update):
+        pass
+
+    @dispatcher.route(state='_start_menu/*/_add')
+    def one_segment(update):
+        pass
+
+    @dispatcher.route(state='_start_menu/**/_edit')
+    def any_segments(update):
+        pass
+
+    @dispatcher.default()
+    def fallback(update):
+        pass
+
+    assert dispatcher.resolve(make_update('/start', '_start_menu/a/_add')) \
+        is start
+    assert dispatcher.resolve(make_update('x', '_start_menu/a/_add')) \
+        is one_segment
+    assert dispatcher.resolve(make_update('x', '_start_menu/a/b/_add')) \
+        is fallback
+    assert dispatcher.resolve(make_update('x', '_start_menu/_edit')) \
+        is any_segments
+    assert dispatcher.resolve(make_update('x', '_start_menu/a/b/_edit')) \
+        is any_segments
+
+
+def test_query_budget_is_counted_not_raised(app_context):
+    dispatcher = Dispatcher(check_queries=True)
+    calls = []
+
+    @dispatcher.route(text='busy', max_queries=1)
+    def busy(update):
+        for _ in range(3):
+            db.session.execute(text('SELECT 1'))
+        calls.append(update.text)
+
+    @dispatcher.route(text='quiet', max_queries=1)
+    def quiet(update):
+        db.session.execute(text('SELECT 1'))
+
+    before = query_budget_exceeded_total._values.get(('busy',), 0)
+    dispatcher.dispatch(make_update('busy'))
+    dispatcher.dispatch(make_update('quiet'))
+
+    assert calls == ['busy']
+    assert query_budget_exceeded_total._values.get(('busy',), 0) == \
+        before + 1
+    assert ('quiet',) not in query_budget_exceeded_total._values
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def call(self, bot_token: str, command: str, data: dict = None) -> dict:
+        self.calls.append((command, data))
+        return {'ok': True, 'result': {}}
+
+
+def test_navigating_button_press_takes_two_queries(database):
+    bot = ChildBot(admin=1, token='3:navigate')
+    db.session.add(bot)
+    db.session.flush()
+    start = Menu(bot_id=bot.id, name='_start_menu')
+    catalog = Menu(bot_id=bot.id, name='catalog', description='Каталог')
+    db.session.add_all([start, catalog])
+    db.session.flush()
+    db.session.add(Button(menu_id=start.id, text='Каталог',
+                          action_type='m', action_name='catalog'))
+    db.session.add(User(bot_id=bot.id, tg_id=2, menu_path='_start_menu'))
+    db.session.commit()
+    bot_id, bot_token = bot.id, bot.token
+
+    def press() -> int:
+        User.query.filter(User.tg_id == 2).update(
+            {'menu_path': '_start_menu'}, synchronize_session=False)
+        db.session.commit()
+        # A context per update, like the webhook, and the user row is
+        # loaded before dispatch as _handle_update does.
+        with app.app_context():
+            user = users.load(bot_id, 2)
+            update = Update(bot_token, 2, 2, 'Каталог', user,
+                            tuple(user.menu_path.split('/')))
+            with count_queries() as queries:
+                routes.dispatcher.dispatch(update)
+            return queries.count
+
+    client = FakeClient()
+    previous = current_client()
+    use_client(client)
+    try:
+        press()
+        # Bot, keyboard and configuration version caches are warm now.
+        count = press()
+    finally:
+        use_client(previous)
+
+    assert count <= 2
+    assert [command for command, _ in client.calls] == ['sendMessage'] * 2
+    assert User.query.filter(User.tg_id == 2).one().menu_path == \
+        '_start_menu/catalog'
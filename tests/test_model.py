@@ -0,0 +1,26 @@
+from app import db
+from app import model
+from app.model import ChildBot
+from app.model import bump_config_version
+from app.model import config_version
+
+
+def test_config_version_is_shared_through_the_database(database):
+    model._config_versions.clear()
+    bot = ChildBot(admin=1, token='2:bot')
+    db.session.add(bot)
+    db.session.commit()
+    assert config_version(bot.id) == 0
+
+    bump_config_version(bot.id)
+    db.session.commit()
+    assert config_version(bot.id) == 1
+
+    # Another process bumps the version; this one notices once its cached
+    # copy expires.
+    db.session.execute(ChildBot.__table__.update().values(
+        config_version=5))
+    db.session.commit()
+    assert config_version(bot.id) == 1
+    model._config_versions.clear()
+    assert config_version(bot.id) == 5
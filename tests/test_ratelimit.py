@@ -0,0 +1,42 @@
+import pytest
+
+from app import ratelimit
+from app.ratelimit import LocalBackend
+from app.ratelimit import RateLimiter
+from app.ratelimit import TokenBucket
+
+
+def test_token_bucket_allows_a_burst_then_spaces_calls(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+    # Paying the debt back takes the waits already handed out.
+    now[0] += 1.0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_local_backend_keeps_buckets_apart_and_bounded():
+    backend = LocalBackend(size=2)
+
+    assert backend.reserve('a', 1, 1) == 0.0
+    assert backend.reserve('a', 1, 1) > 0
+    assert backend.reserve('b', 1, 1) == 0.0
+
+    backend.reserve('c', 1, 1)
+    assert list(backend._buckets) == ['b', 'c']
+
+
+def test_rate_limiter_stats_are_bounded():
+    limiter = RateLimiter(LocalBackend(size=100), stats_size=2)
+
+    for bot_token in ('1:a', '2:b', '1:a', '3:c'):
+        limiter.acquire(bot_token)
+
+    stats = limiter.stats()
+    assert set(stats) == {'1', '3'}
+    assert stats['1'][0] == 2
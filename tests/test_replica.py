@@ -0,0 +1,55 @@
+from flask import g
+from sqlalchemy import create_engine
+
+from app import db
+from app import replica
+from app.model import Menu
+
+
+def test_read_query_uses_replica(database, tmp_path, monkeypatch):
+    engine = create_engine(f'sqlite:///{tmp_path / "replica.db"}')
+    db.Model.metadata.create_all(engine)
+    engine.execute(Menu.__table__.insert().values(
+        bot_id=1, name='from_replica'))
+
+    monkeypatch.setattr(replica, 'replica_engine', engine)
+    monkeypatch.setattr(replica, 'replica_session',
+                        replica.create_replica_session(engine))
+    try:
+        names = [menu.name for menu in replica.read_query(Menu).all()]
+        assert names == ['from_replica']
+
+        # After a write the update reads from the primary.
+        g.read_primary = True
+        assert replica.read_query(Menu).all() == []
+        assert replica.read_query(Menu, follow_writes=False).count() == 1
+
+        g.read_primary = False
+        with replica.on_primary():
+            assert replica.read_query(Menu).all() == []
+    finally:
+        replica.replica_session.remove()
+
+
+def test_only_commits_that_wrote_switch_to_primary(database, tmp_path,
+                                                   monkeypatch):
+    engine = create_engine(f'sqlite:///{tmp_path / "replica.db"}')
+    db.Model.metadata.create_all(engine)
+    engine.execute(Menu.__table__.insert().values(
+        bot_id=1, name='from_replica'))
+
+    monkeypatch.setattr(replica, 'replica_engine', engine)
+    monkeypatch.setattr(replica, 'replica_session',
+                        replica.create_replica_session(engine))
+    try:
+        db.session.commit()
+        assert not g.get('read_primary', False)
+        assert replica.read_query(Menu).count() == 1
+
+        db.session.add(Menu(bot_id=1, name='on_primary'))
+        db.session.commit()
+        assert g.read_primary
+        names = [menu.name for menu in replica.read_query(Menu).all()]
+        assert names == ['on_primary']
+    finally:
+        replica.replica_session.remove()
@@ -0,0 +1,28 @@
+from collections import Counter
+
+from app.sharding import HashRing
+
+KEYS = [str(900000000 + bot) for bot in range(10000)]
+
+
+def test_keys_spread_over_all_nodes():
+    ring = HashRing(['a', 'b', 'c', 'd'], 100)
+    owners = Counter(ring.node(key) for key in KEYS)
+
+    assert set(owners) == {'a', 'b', 'c', 'd'}
+    for node, keys in owners.items():
+        assert abs(keys - len(KEYS) / 4) < len(KEYS) / 4 * 0.3, node
+
+
+def test_adding_a_node_moves_about_one_nth_of_the_keys():
+    before = HashRing(['a', 'b', 'c', 'd'], 100)
+    after = HashRing(['a', 'b', 'c', 'd', 'e'], 100)
+
+    moved = [key for key in KEYS if before.node(key) != after.node(key)]
+
+    assert {after.node(key) for key in moved} == {'e'}
+    assert abs(len(moved) / len(KEYS) - 1 / 5) < 0.05
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([], 100).node('1') is None